@@ -0,0 +1,208 @@
+#!/usr/bin/python3.4
+# An in-memory stand-in for db.DB, so the benchmarks run without a database.
+# Every call counts as one round trip, and can be slowed down by `latency`
+# seconds to mimic the network.
+import re
+import threading
+import time
+from db import DB, DuplicateKey, SEARCH_MAX_CHARS
+
+class MemoryDB:
+    """ Implements the db.DB interface used by the app on top of dicts """
+
+    # The key column of each table, the first one of its schema, or the columns of its PRIMARY KEY (...)
+    keys = dict((name, info[1].split()[0]) for name, info in DB.tables.items())
+    for name, info in DB.tables.items():
+        match = re.search(r"PRIMARY KEY \((.*?)\)", info[1])
+        if match:
+            keys[name] = tuple(c.strip() for c in match.group(1).split(','))
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.tables = dict((name, {}) for name in DB.tables)
+        self.lock = threading.Lock()
+        self.queries = 0
+
+    def query(self):
+        """ Count a round trip """
+        with self.lock:
+            self.queries += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def close(self):
+        pass
+
+    def notify(self, channel, payload):
+        self.query()
+
+    def listen(self, channel, callback):
+        pass # A single process, nobody else to hear from
+
+    def has_table(self, table_name):
+        return table_name in self.tables
+
+    def key(self, table_name, row):
+        key = self.keys[table_name]
+        if isinstance(key, tuple):
+            return tuple(row[c] for c in key)
+        return row[key]
+
+    def add_data(self, table_name, data):
+        self.query()
+        self.tables[table_name][self.key(table_name, data)] = dict(data)
+        return True
+
+    def add_unique(self, table_name, data):
+        self.query()
+        with self.lock:
+            rows = self.tables[table_name]
+            key = self.key(table_name, data)
+            if key in rows:
+                raise DuplicateKey(key)
+            rows[key] = dict(data)
+        return True
+
+    def add_many(self, table_name, rows, page_size=500, ignore_duplicates=False):
+        rows = list(rows)
+        for i in range(0, len(rows), page_size):
+            self.query()
+        with self.lock:
+            for row in rows:
+                key = self.key(table_name, row)
+                if not ignore_duplicates or key not in self.tables[table_name]:
+                    self.tables[table_name][key] = dict(row)
+        return True
+
+    def upsert_data(self, table_name, data, key_column='id'):
+        self.query()
+        # psycopg2 adapters (i.e. Binary) are kept as the value they wrap
+        data = dict((k, getattr(v, 'adapted', v)) for k, v in data.items())
+        with self.lock:
+            self.tables[table_name].setdefault(data[key_column], {}).update(data)
+        return True
+
+    def add_reference(self, table_name, data, key_column, count_column, insert=True):
+        self.query()
+        with self.lock:
+            if not insert and data[key_column] not in self.tables[table_name]:
+                return 0
+            row = self.tables[table_name].setdefault(data[key_column], dict(data, **{count_column: 0}))
+            row[count_column] += 1
+            return row[count_column]
+
+    def drop_reference(self, table_name, key_column, key_value, count_column, cascade=()):
+        self.query()
+        with self.lock:
+            return self.__drop_reference(table_name, key_value, count_column, cascade)
+
+    def __drop_reference(self, table_name, key_value, count_column, cascade):
+        row = self.tables[table_name].get(key_value)
+        if row is None:
+            return 0
+        row[count_column] -= 1
+        if row[count_column] <= 0:
+            del self.tables[table_name][key_value]
+            for other_table, column in cascade:
+                rows = self.tables[other_table]
+                for key, other in list(rows.items()):
+                    if other.get(column) == key_value:
+                        del rows[key]
+            return 0
+        return row[count_column]
+
+    def delete_paste(self, id):
+        self.query()
+        with self.lock:
+            row = self.tables['pastes'].pop(id, None)
+            if row is None:
+                return None
+            if not row.get('content_hash'):
+                return (None, 0)
+            return (row['content_hash'], self.__drop_reference('blobs', row['content_hash'], 'refs', [('chunks', 'hash')]))
+
+    def index_text(self, table_name, key_column, key_value, column, text):
+        self.query()
+        row = self.tables[table_name].get(key_value)
+        if row is not None:
+            row[column] = set(text[:SEARCH_MAX_CHARS].lower().split())
+        return True
+
+    def get_chunks(self, content_hash, first, last):
+        self.query()
+        rows = self.tables['chunks']
+        return [(number, rows[(content_hash, number)]['content']) for number in range(first, last + 1)
+                if (content_hash, number) in rows]
+
+    def list_pastes(self, columns, filters=None, since=None, until=None, text=None, after=None, limit=50):
+        self.query()
+        rows = []
+        for row in list(self.tables['pastes'].values()):
+            if any(row.get(column) != value for column, value in (filters or {}).items()):
+                continue
+            created_at = row['created_at'].replace(tzinfo=None)
+            if (since is not None and created_at < since) or (until is not None and created_at >= until):
+                continue
+            if after is not None and (row['created_at'], row['id']) >= tuple(after):
+                continue
+            if text:
+                words = self.tables['blobs'].get(row['content_hash'], {}).get('search') or set()
+                if not set(text.lower().split()) <= words:
+                    continue
+            rows.append(row)
+        rows.sort(key=lambda row: (row['created_at'], row['id']), reverse=True)
+        return [self.__select('pastes', row, columns) for row in rows[:limit]]
+
+    def get_data(self, table_name, condition_column_name, condition_value, columns=None):
+        self.query()
+        rows = self.tables[table_name]
+        if condition_column_name == self.keys[table_name]:
+            matches = [rows[condition_value]] if condition_value in rows else []
+        else:
+            matches = [row for row in list(rows.values()) if row.get(condition_column_name) == condition_value]
+        return [self.__select(table_name, row, columns) for row in matches]
+
+    def get_all_data(self, table_name, columns=None):
+        self.query()
+        return [self.__select(table_name, row, columns) for row in list(self.tables[table_name].values())]
+
+    def delete_data(self, table_name, condition_column_name, condition_value):
+        self.query()
+        with self.lock:
+            rows = self.tables[table_name]
+            for key, row in list(rows.items()):
+                if row.get(condition_column_name) == condition_value:
+                    del rows[key]
+        return True
+
+    def update_data(self, table_name, column_name, changed_value, condition_column_name, condition_value):
+        self.query()
+        with self.lock:
+            for row in self.tables[table_name].values():
+                if row.get(condition_column_name) == condition_value:
+                    row[column_name] = changed_value
+        return True
+
+    def delete_older_than(self, table_name, column_name, value):
+        self.query()
+        with self.lock:
+            rows = self.tables[table_name]
+            for key, row in list(rows.items()):
+                if row.get(column_name) is not None and row[column_name] < value:
+                    del rows[key]
+        return True
+
+    def count_data(self, table_name, condition_column_name=None, condition_value=None):
+        self.query()
+        if condition_column_name is None:
+            return len(self.tables[table_name])
+        return len([row for row in list(self.tables[table_name].values())
+                    if row.get(condition_column_name) == condition_value])
+
+    def __select(self, table_name, row, columns):
+        if columns is None:
+            columns = [c.split()[0] for c in DB.tables[table_name][1].split(',')]
+        return tuple(row.get(c) for c in columns)
+
+    def __repr__(self):
+        return '<MemoryDB {0} queries>'.format(self.queries)
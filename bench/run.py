@@ -0,0 +1,266 @@
+#!/usr/bin/python3.4
+# Benchmarks of the paste create/view/raw hot paths.
+#
+# Run from the repository root:
+#
+#     python bench/run.py                      # against an in-memory stand-in of db.DB
+#     python bench/run.py --postgres           # against the db in db.yaml (adds pastes to it!)
+#     python bench/run.py --compare bench/results/<old commit>.json
+#
+# Reports throughput, p50/p99 latency and db round trips of each operation,
+# plus the peak RSS, and saves them as JSON under bench/results/ (named after
+# the current commit) so runs of different commits can be compared.
+import argparse
+import contextlib
+import io
+import json
+import os
+import os.path
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT) # templates, languages.json and pasteit.conf are looked up from here
+
+import db
+
+# Content sizes (bytes) and how often they're pasted
+SIZES = ((1024, 40), (16 * 1024, 30), (128 * 1024, 18), (1024 * 1024, 10), (5 * 1024 * 1024, 2))
+# Languages pastes are created with, "guess" has them detected
+LANGUAGES = ('guess', 'guess', 'py3', 'js', 'c', 'text')
+# Highlighting bigger pastes than this synchronously takes too long to time
+HIGHLIGHT_MAX = 256 * 1024
+
+class CountingDB(db.DB):
+    """ db.DB counting the statements it runs """
+
+    queries = 0
+
+    @contextlib.contextmanager
+    def cursor(self, autocommit=False):
+        with db.DB.cursor(self, autocommit) as cur:
+            yield CountingCursor(self, cur)
+
+class CountingCursor:
+    def __init__(self, db, cursor):
+        self.db = db
+        self.cursor = cursor
+
+    def execute(self, *args):
+        self.db.queries += 1
+        return self.cursor.execute(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+def sample_sources():
+    """ Real code to build paste contents from """
+    sources = []
+    for directory in ("src", "bench"):
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".py"):
+                with open(os.path.join(directory, name), 'r', encoding='utf-8') as f:
+                    sources.append(f.read())
+    return sources
+
+def make_content(size, rnd, sources):
+    """ About `size` bytes of code, varied so pastes don't deduplicate """
+    parts = ["# paste {0}\n".format(rnd.getrandbits(64))]
+    length = len(parts[0])
+    while length < size:
+        part = rnd.choice(sources)
+        parts.append(part)
+        length += len(part)
+    return "".join(parts)[:size]
+
+def make_pastes(count, rnd, max_size):
+    sources = sample_sources()
+    sizes = [size for size, weight in SIZES if size <= max_size]
+    weights = [weight for size, weight in SIZES if size <= max_size]
+    pastes = []
+    for i in range(count):
+        size = weighted(rnd, sizes, weights)
+        pastes.append((make_content(size, rnd, sources), rnd.choice(LANGUAGES)))
+    return pastes
+
+def weighted(rnd, values, weights):
+    point = rnd.uniform(0, sum(weights))
+    for value, weight in zip(values, weights):
+        point -= weight
+        if point <= 0:
+            return value
+    return values[-1]
+
+def call(app, path):
+    """ Make a GET request to the WSGI app, returns the status and body size """
+    env = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': '',
+           'SERVER_NAME': 'bench', 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1', 'HTTP_HOST': 'bench',
+           'HTTP_ACCEPT_ENCODING': 'gzip', 'wsgi.url_scheme': 'http', 'wsgi.input': io.BytesIO(),
+           'wsgi.errors': sys.stderr, 'wsgi.version': (1, 0), 'wsgi.multithread': True,
+           'wsgi.multiprocess': False, 'wsgi.run_once': False, 'REMOTE_ADDR': '127.0.0.1'}
+    status = []
+    def start_response(s, headers, exc_info=None):
+        status.append(s)
+    body = app(env, start_response)
+    try:
+        size = sum(len(chunk) for chunk in body)
+    finally:
+        body.close() # Runs the end of request hooks
+    if not status[0].startswith('200'):
+        raise RuntimeError("GET {0}: {1}".format(path, status[0]))
+    return size
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[int(round(p * (len(values) - 1)))]
+
+class Timings:
+    """ Latencies and db round trips of each operation """
+
+    def __init__(self, database):
+        self.database = database
+        self.results = {}
+
+    def time(self, operation, function, *args):
+        queries = self.database.queries
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        latencies, trips = self.results.setdefault(operation, ([], []))
+        latencies.append(elapsed)
+        trips.append(self.database.queries - queries)
+        return result
+
+    def report(self):
+        report = {}
+        for operation, (latencies, trips) in self.results.items():
+            report[operation] = {'count': len(latencies),
+                'throughput': len(latencies) / sum(latencies) if sum(latencies) else None,
+                'p50_ms': percentile(latencies, 0.5) * 1000,
+                'p99_ms': percentile(latencies, 0.99) * 1000,
+                'round_trips': sum(trips) / len(trips)}
+        return report
+
+def wait_for_renders(renderer, timeout):
+    deadline = time.time() + timeout
+    while renderer.queued() and time.time() < deadline:
+        time.sleep(0.05)
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def run(args):
+    if args.postgres:
+        db.DB = CountingDB
+    else:
+        from memorydb import MemoryDB
+        db.DB = lambda: MemoryDB(args.latency)
+    # Imported after picking the db, repo connects on import
+    import cherrypy
+    import pasteit
+    import repo
+
+    cherrypy.config.update({'environment': 'embedded', 'log.screen': False})
+    cherrypy.server.unsubscribe()
+    app = pasteit.mount()
+    cherrypy.engine.start()
+    repo.renders.directory = None # Time highlighting, not reading old renders from disk
+    database = repo.db
+    pastes_repo = pasteit.pastes_repo
+    timings = Timings(database)
+    rnd = random.Random(args.seed)
+    try:
+        contents = make_pastes(args.pastes, rnd, args.max_size)
+        ids = []
+        for content, language in contents:
+            ids.append(timings.time('create', pastes_repo.create, content, "", "bench", language))
+        wait_for_renders(repo.renderer, args.render_timeout)
+        for i in range(args.rounds):
+            for id in ids:
+                # Loading from the db, then from the cache
+                pastes_repo.pastes.pop(id)
+                paste = timings.time('get', pastes_repo.get, id)
+                timings.time('get_cached', pastes_repo.get, id)
+                timings.time('formatted_content', paste.formattedContent)
+                if len(paste.content) <= args.highlight_max:
+                    timings.time('highlight', repo.render.render, paste.content, paste.language)
+                # Whole pages, built and then from the page cache
+                repo.pages.invalidate(id)
+                timings.time('view', call, app, '/' + id)
+                timings.time('view_cached', call, app, '/' + id)
+                timings.time('raw', call, app, '/raw/' + id)
+                timings.time('raw_cached', call, app, '/raw/' + id)
+    finally:
+        cherrypy.engine.exit()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {'commit': commit(),
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'python': platform.python_version(),
+        'backend': 'postgres' if args.postgres else 'memory',
+        'settings': {'pastes': args.pastes, 'rounds': args.rounds, 'seed': args.seed, 'latency': args.latency,
+                     'max_size': args.max_size, 'highlight_max': args.highlight_max},
+        'peak_rss_kb': usage.ru_maxrss,
+        'peak_rss_children_kb': children.ru_maxrss,
+        'operations': timings.report()}
+
+def show(results):
+    print("{0} ({1}, {2} pastes)".format(results['commit'], results['backend'], results['settings']['pastes']))
+    print("{0:<18} {1:>7} {2:>10} {3:>10} {4:>10} {5:>8}".format("operation", "count", "ops/s", "p50 ms", "p99 ms", "trips"))
+    for operation, result in sorted(results['operations'].items()):
+        print("{0:<18} {1:>7} {2:>10.1f} {3:>10.3f} {4:>10.3f} {5:>8.2f}".format(operation, result['count'],
+            result['throughput'] or 0, result['p50_ms'], result['p99_ms'], result['round_trips']))
+    print("peak RSS: {0} KB (render processes: {1} KB)".format(results['peak_rss_kb'], results['peak_rss_children_kb']))
+
+def compare(old, new):
+    """ Print how each operation changed between two runs """
+    print("{0} -> {1}".format(old['commit'], new['commit']))
+    for operation, result in sorted(new['operations'].items()):
+        before = old['operations'].get(operation)
+        if not before:
+            continue
+        changes = []
+        for key in ('p50_ms', 'p99_ms'):
+            if before[key]:
+                changes.append("{0} {1:+.1f}%".format(key, (result[key] - before[key]) * 100 / before[key]))
+        changes.append("trips {0:+.2f}".format(result['round_trips'] - before['round_trips']))
+        print("{0:<18} {1}".format(operation, ", ".join(changes)))
+    if old['peak_rss_kb']:
+        print("peak RSS {0:+.1f}%".format((new['peak_rss_kb'] - old['peak_rss_kb']) * 100 / old['peak_rss_kb']))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the paste create/view/raw paths")
+    parser.add_argument('--postgres', action='store_true', help="use the db configured in db.yaml")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to each in-memory db call")
+    parser.add_argument('--pastes', type=int, default=100)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--max-size', type=int, default=5 * 1024 * 1024, help="biggest paste size")
+    parser.add_argument('--highlight-max', type=int, default=HIGHLIGHT_MAX, help="biggest paste to highlight synchronously")
+    parser.add_argument('--render-timeout', type=float, default=300, help="seconds to wait for background renders")
+    parser.add_argument('--output', help="where to save the results (default bench/results/<commit>.json)")
+    parser.add_argument('--compare', help="results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    results = run(args)
+    show(results)
+    output = args.output or os.path.join(ROOT, "bench", "results", results['commit'] + ".json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print("Saved to " + output)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(json.load(f), results)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+#!/usr/bin/python3.5
+import asyncio
+import concurrent.futures
+import functools
+
+class AsyncDB:
+    """ Awaitable mirror of db.DB, for the asyncio serving mode
+
+    Every DB method (get_data, upsert_data, delete_data, ...) has an
+    awaitable counterpart with the same arguments. The calls run on a
+    thread pool as large as the connection pool, so the event loop never
+    waits on the network and the db sees at most pool.maxconn queries at once.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.executor = concurrent.futures.ThreadPoolExecutor(db.pool.maxconn)
+
+    def run(self, function, *args, **kwargs):
+        """ Run a blocking function (i.e. one querying the db) off the event loop """
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor, functools.partial(function, *args, **kwargs))
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    def __getattr__(self, name):
+        method = getattr(self.db, name)
+        if not callable(method):
+            return method
+        def call(*args, **kwargs):
+            return self.run(method, *args, **kwargs)
+        return call
+
+    def __repr__(self):
+        return '<Async {0!r}>'.format(self.db)
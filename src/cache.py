@@ -0,0 +1,144 @@
+#!/usr/bin/python3.4
+import collections
+import gzip
+import hashlib
+import threading
+
+class LRUCache:
+    """ A thread-safe least-recently-used cache, bounded by number of entries and total size """
+
+    def __init__(self, max_items=None, max_bytes=None, sizeof=len):
+        self.max_items = max_items # None means unbounded
+        self.max_bytes = max_bytes # None means unbounded
+        self.sizeof = sizeof       # How to measure an entry for max_bytes
+        self.entries = collections.OrderedDict() # key -> (value, size), least recently used first
+        self.size = 0
+        self.lock = threading.Lock()
+        # Usage statistics, see stats()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """ Get an entry, marking it as recently used """
+        with self.lock:
+            try:
+                value, size = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """ Add or replace an entry, evicting the least recently used ones to make room """
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            # Entries bigger than the whole cache are not worth keeping
+            if self.max_bytes is not None and size > self.max_bytes:
+                return False
+            self.entries[key] = (value, size)
+            self.size += size
+            while ((self.max_items is not None and len(self.entries) > self.max_items) or
+                   (self.max_bytes is not None and self.size > self.max_bytes)):
+                old_key, (old_value, old_size) = self.entries.popitem(last=False)
+                self.size -= old_size
+                self.evictions += 1
+            return True
+
+    def pop(self, key, default=None):
+        """ Remove an entry and return it """
+        with self.lock:
+            try:
+                value, size = self.entries.pop(key)
+            except KeyError:
+                return default
+            self.size -= size
+            return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """ Return usage counters """
+        with self.lock:
+            return {'entries': len(self.entries),
+                'bytes': self.size,
+                'max_items': self.max_items,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def __repr__(self):
+        return '<LRUCache {0} entries, {1} bytes>'.format(len(self), self.size)
+
+# A cached response: the body, its gzip compressed copy, a strong ETag and the Last-Modified time
+Page = collections.namedtuple('Page', 'body gzipped etag modified')
+
+class PageCache:
+    """ Whole responses of the paste pages, keyed by (route, paste id, auth state) """
+
+    def __init__(self, max_bytes, max_invalidated=10000):
+        self.pages = LRUCache(max_bytes=max_bytes, sizeof=lambda page: len(page.body) + len(page.gzipped))
+        self.variants = set() # (route, auth state) pairs seen, to find the pages of a paste
+        self.lock = threading.Lock()
+        # Pages built from a paste invalidated meanwhile aren't kept, see version()
+        self.generation = 0                          # bumped by every invalidation
+        self.invalidated = collections.OrderedDict() # paste id -> generation of its last invalidation
+        self.max_invalidated = max_invalidated
+        self.forgotten = 0                           # latest generation dropped from invalidated
+
+    def get(self, route, id, auth=False):
+        """ Return the cached Page, or None """
+        return self.pages.get((route, id, auth))
+
+    def version(self):
+        """ Return the current generation, to take before loading a paste and pass to put() """
+        with self.lock:
+            return self.generation
+
+    def put(self, route, id, body, auth=False, etag=None, modified=None, gzipped=None, since=None):
+        """ Cache a response body (bytes) and return its Page. `gzipped` is the body already compressed, if at hand.
+        A page built from a paste invalidated after version() returned `since` is returned but not kept """
+        if gzipped is None:
+            gzipped = gzip.compress(body)
+        page = Page(body, gzipped, etag or hashlib.sha1(body).hexdigest(), modified)
+        with self.lock:
+            if since is not None and self.invalidated.get(id, self.forgotten) > since:
+                return page
+            self.variants.add((route, auth))
+            # Under the lock, so an invalidation can't slip in between the check and the put
+            self.pages.put((route, id, auth), page)
+        return page
+
+    def invalidate(self, id):
+        """ Drop every cached page of a paste """
+        with self.lock:
+            self.generation += 1
+            self.invalidated.pop(id, None)
+            self.invalidated[id] = self.generation
+            while len(self.invalidated) > self.max_invalidated:
+                self.forgotten = self.invalidated.popitem(last=False)[1]
+            variants = list(self.variants)
+        for route, auth in variants:
+            self.pages.pop((route, id, auth))
+
+    def stats(self):
+        return self.pages.stats()
+
+    def __repr__(self):
+        return '<PageCache {0}>'.format(self.pages)
@@ -0,0 +1,86 @@
+#!/usr/bin/python3.4
+# Big paste contents are stored as a list of chunks, cut at line ends, so a
+# window of lines (or the raw download) can be read a chunk at a time.
+#
+# The blobs row of a chunked content keeps no content, just its line index:
+# the number of the first line of each chunk. The chunks themselves are rows of
+# the chunks table, (hash, number), each stored as in compression.py.
+import bisect
+import codecs
+
+# Contents longer than this (in utf-8 bytes, whichever way they come in) are stored in chunks
+CHUNKED_MIN = 256 * 1024
+# About how many characters go in a chunk, more when a line is longer than that
+CHUNK_CHARS = 64 * 1024
+
+def count_lines(text):
+    """ Number of lines of a text, the last one may not end with a newline """
+    if not text:
+        return 0
+    return text.count('\n') + (0 if text.endswith('\n') else 1)
+
+def split(content, size=CHUNK_CHARS):
+    """ Cut a content into chunks of whole lines. Returns a list of (first line, text) """
+    parts = []
+    start = 0
+    line = 1
+    while start < len(content):
+        end = content.find('\n', start + size - 1)
+        end = len(content) if end == -1 else end + 1
+        text = content[start:end]
+        parts.append((line, text))
+        line += text.count('\n')
+        start = end
+    return parts
+
+def split_blocks(blocks, size=CHUNK_CHARS):
+    """ Like split(), for a text coming as an iterable of blocks, holding about a chunk of it at once """
+    blocks = iter(blocks)
+    pending = ""
+    line = 1
+    while True:
+        cut = pending.find('\n', size - 1)
+        while cut == -1:
+            block = next(blocks, None)
+            if block is None:
+                break
+            searched = max(size - 1, len(pending))
+            pending += block
+            cut = pending.find('\n', searched)
+        if cut == -1:
+            if pending:
+                yield (line, pending)
+            return
+        text, pending = pending[:cut + 1], pending[cut + 1:]
+        yield (line, text)
+        line += text.count('\n')
+
+def decode(file, size=CHUNK_CHARS):
+    """ Yield the text of a binary utf-8 file, a block at a time. Raises UnicodeDecodeError on invalid utf-8 """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    while True:
+        block = file.read(size)
+        text = decoder.decode(block, final=not block)
+        if text:
+            yield text
+        if not block:
+            return
+
+def locate(line_index, line):
+    """ Number of the chunk holding a line """
+    return max(bisect.bisect_right(line_index, line) - 1, 0)
+
+def select_lines(text, start_line, first, last):
+    """ Cut lines first to last (inclusive) out of a text starting at line start_line """
+    begin = 0
+    for i in range(first - start_line):
+        begin = text.find('\n', begin) + 1
+        if begin == 0:
+            return ""
+    end = begin
+    for i in range(last - first + 1):
+        end = text.find('\n', end) + 1
+        if end == 0:
+            end = len(text)
+            break
+    return text[begin:end]
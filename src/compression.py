@@ -0,0 +1,40 @@
+#!/usr/bin/python3.4
+import hashlib
+import zlib
+
+# Stored paste contents start with a marker byte telling how the rest is encoded
+RAW = b'\x00'  # utf-8 text
+GZIP = b'\x01' # gzip compressed utf-8 text, can be sent as is with Content-Encoding: gzip
+
+# Contents smaller than this aren't worth compressing
+COMPRESS_MIN = 256
+
+def gzip(data):
+    """ Gzip bytes, with a zeroed timestamp so the output only depends on the input """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+def pack(content):
+    """ Encode a paste content (str, or its utf-8 bytes) for storage """
+    data = content if isinstance(content, bytes) else content.encode('utf-8')
+    if len(data) >= COMPRESS_MIN:
+        compressed = gzip(data)
+        if len(compressed) < len(data):
+            return GZIP + compressed
+    return RAW + data
+
+def unpack(blob):
+    """ Decode a stored paste content """
+    if blob[:1] == GZIP:
+        return zlib.decompress(blob[1:], 47).decode('utf-8')
+    return bytes(blob[1:]).decode('utf-8')
+
+def gzipped(blob):
+    """ Return the gzip stream of a stored content, or None if it's stored uncompressed """
+    if blob[:1] == GZIP:
+        return bytes(blob[1:])
+    return None
+
+def content_hash(content):
+    """ Return the hex digest identifying a paste content (str, or its utf-8 bytes), the key of its stored blob """
+    return hashlib.sha256(content if isinstance(content, bytes) else content.encode('utf-8')).hexdigest()
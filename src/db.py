@@ -1,60 +1,355 @@
 import psycopg2
+import psycopg2.errorcodes
+import psycopg2.extensions
+import psycopg2.pool
 import yaml
+import metrics
+import migrations
 import os.path
+import re
+import select
+import threading
+import time
+from contextlib import contextmanager
+
+# Text search configuration of the blobs search column. Pastes are mostly code, so words aren't stemmed
+SEARCH_CONFIG = 'simple'
+# Only the beginning of big contents is indexed, a tsvector can't exceed 1 MB
+SEARCH_MAX_CHARS = 256 * 1024
+
+class DuplicateKey(Exception):
+    """ Raised by DB.add_unique when the row violates a unique constraint """
+    pass
+
+def identifier(name):
+    """ Validate a table/column name before it's interpolated into SQL """
+    if not re.match(r"^[A-Za-z_][A-Za-z0-9_]*$", name):
+        raise ValueError("Invalid SQL identifier: %r" % name)
+    return name
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """ Cursor counting the statements it runs, for /metrics """
+
+    def execute(self, query, vars=None):
+        metrics.count('db_queries_total')
+        return super().execute(query, vars)
+
+def load_config():
+    """ Read and parse db.yaml """
+    with open(os.path.dirname(__file__) + "/../db.yaml", 'r') as settings_file:
+        return yaml.safe_load(settings_file)
+
+class ConnectionPool:
+    """ A bounded, thread-safe pool of persistent connections
+
+    CherryPy serves each request in its own worker thread, so a thread checks
+    a connection out for the duration of one DB operation and hands it back.
+    When every connection is in use, callers wait (up to `timeout` seconds)
+    for one to be returned instead of opening more than `maxconn`.
+    """
+
+    def __init__(self, settings, minconn=1, maxconn=10, timeout=30, check_after=30):
+        self.settings = settings
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout          # max seconds to wait for a free connection
+        self.check_after = check_after  # ping connections idle for longer than this
+        self.idle = []                  # (connection, last used) pairs ready to hand out
+        self.opened = 0                 # idle + checked out connections
+        self.cond = threading.Condition()
+        # Usage statistics, see stats()
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.timeouts = 0
+        self.reconnects = 0
+        for i in range(minconn):
+            try:
+                self.idle.append((self.__open(), time.time()))
+                self.opened += 1
+            except psycopg2.Error as e:
+                print("!! Error opening pooled db connection")
+                print(e)
+                break
+
+    def __open(self):
+        metrics.count('db_connections_opened_total')
+        return psycopg2.connect(**self.settings)
+
+    def __healthy(self, conn, last_used):
+        """ Check a connection before handing it out """
+        if conn.closed:
+            return False
+        if time.time() - last_used < self.check_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        """ Check out a connection, waiting for one if the pool is exhausted """
+        start = time.time()
+        conn = None
+        with self.cond:
+            while not self.idle and self.opened >= self.maxconn:
+                remaining = start + self.timeout - time.time()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise psycopg2.pool.PoolError("timed out waiting for a db connection (maxconn=%d)" % self.maxconn)
+                self.cond.wait(remaining)
+            if self.idle:
+                conn, last_used = self.idle.pop()
+            else:
+                self.opened += 1 # reserve a slot, the connection is opened outside the lock
+            waited = time.time() - start
+            self.checkouts += 1
+            if waited > 0.001:
+                self.waits += 1
+            self.wait_time += waited
+            self.max_wait = max(self.max_wait, waited)
+        if waited > 1:
+            print("!! Waited %.2fs for a db connection (maxconn=%d)" % (waited, self.maxconn))
+        try:
+            if conn is None:
+                conn = self.__open()
+            elif not self.__healthy(conn, last_used):
+                print(".. Reconnecting stale db connection")
+                self.__close(conn)
+                self.reconnects += 1
+                conn = self.__open()
+        except BaseException:
+            self.__release_slot()
+            raise
+        return conn
+
+    def putconn(self, conn, broken=False):
+        """ Return a connection to the pool, discarding it if broken """
+        if not broken and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        if broken or conn.closed:
+            self.__close(conn)
+            self.__release_slot()
+        else:
+            with self.cond:
+                self.idle.append((conn, time.time()))
+                self.cond.notify()
+
+    def closeall(self):
+        """ Close every idle connection """
+        with self.cond:
+            idle, self.idle = self.idle, []
+            self.opened -= len(idle)
+            self.cond.notify_all()
+        for conn, last_used in idle:
+            self.__close(conn)
+
+    def stats(self):
+        """ Return usage counters, useful to size maxconn """
+        with self.cond:
+            return {'maxconn': self.maxconn,
+                'open': self.opened,
+                'idle': len(self.idle),
+                'in_use': self.opened - len(self.idle),
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'wait_max': self.max_wait,
+                'wait_avg': self.wait_time / self.checkouts if self.checkouts else 0.0,
+                'timeouts': self.timeouts,
+                'reconnects': self.reconnects}
+
+    def __release_slot(self):
+        with self.cond:
+            self.opened -= 1
+            self.cond.notify()
+
+    def __close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
 
 class DB:
     
     # info for all tables.  # increment version number when updating create (look at self.__on_upgrade() too)
     tables = {
         #    table     | version,    schema
-            'pastes'   : (1,
-                    "id          text PRIMARY KEY, " +
-                    "content     text, " +
+            'pastes'   : (4,
+                    "id           text PRIMARY KEY, " +
+                    "content_hash text, " +     # the contents are in blobs
                     "author      text, " +
                     "language    text, " +
                     "password    text, " +
                     "temporary   boolean, " +
-                    "created     text")
+                    "created     text, " +      # as shown, "%m/%d/%y at %H:%M:%S"
+                    "created_at  timestamptz"), # for sorting and ranges
+            'blobs'    : (3,
+                    "hash        text PRIMARY KEY, " +
+                    "content     bytea, " +     # see compression.py, NULL when stored in chunks
+                    "refs        integer NOT NULL, " + # how many pastes have this content
+                    "search      tsvector, " +  # full text search, see index_text
+                    "lines       integer, " +
+                    "size        integer, " +   # utf-8 bytes
+                    "line_index  integer[]"),   # first line of each chunk, see chunks.py
+            'chunks'   : (1,
+                    "hash        text NOT NULL, " + # of the blob
+                    "number      integer NOT NULL, " +
+                    "content     bytea NOT NULL, " + # see compression.py
+                    "PRIMARY KEY (hash, number)"),
+            'rate_limits' : (1,
+                    "bucket      text PRIMARY KEY, " + # client ip and route, see ratelimit.py
+                    "tokens      double precision NOT NULL, " +
+                    "updated     timestamptz NOT NULL"),
+            'sessions' : (1,
+                    "id              text PRIMARY KEY, " +
+                    "data            bytea, " +
+                    "expiration_time timestamp")
+            }
+    # indexes of the tables besides their primary key: (name, definition)
+    indexes = {
+            'pastes'   : (("pastes_author", "(author, created_at, id)"),
+                          ("pastes_language", "(language, created_at, id)"),
+                          ("pastes_created", "(created_at, id)"),
+                          ("pastes_temporary", "(id) WHERE temporary")),
+            'blobs'    : (("blobs_search", "USING gin (search)"), )
             }
     # unmanaged_tables are left alone by the automatic table handling - don't get created, updated etc
     unmanaged_tables = ()
+    # records the version each managed table is at. Tables created before it existed are at version 1
+    versions_table = ('schema_version', "table_name text PRIMARY KEY, version integer NOT NULL")
     
     # future table ideas:  
     #   mail: "_id integer PRIMARY KEY DEFAULT nextval('serial'), sender text NOT NULL, recipient text NOT NULL, time_sent integer NOT NULL, message text NOT NULL"
     #   proj: "_id integer PRIMARY KEY DEFAULT nextval('serial'), name text NOT NULL, lang text NULL, owner text NOT NULL, link text NULL, descrip text NOT NULL, status text"
     #   user: possibly include timezone settings to localise timestamps on logs, mail etc for each user (maybe with a '!!me' command group)
     
-    def __init__(self):
-        # test that all (managed) tables exist and are at correct version (version check not implemented yet)
-        self.__ensure_all_tables_correct()
-        self.tables = {
-        #    table     | version,    schema
-            'pastes'   : (1,
-                    "id          text PRIMARY KEY, " +
-                    "content     text, " +
-                    "author      text, " +
-                    "language    text, " +
-                    "password    text, " +
-                    "temporary   boolean, " +
-                    "created     text")
-            }
+    def __init__(self, migrate=None):
+        # parse db.yaml once and keep a pool of connections for the life of the process
+        conf = load_config()
+        pool_conf = conf.get('pool') or {}
+        self.settings = {'database': conf['database']['name'],
+                        'user':     conf['database']['user'],
+                        'password': conf['database']['pass'],
+                        'host':     conf['database']['host'],
+                        'port':     conf['database']['port']}
+        self.pool = ConnectionPool(self.settings,
+                        minconn     = pool_conf.get('minconn', 1),
+                        maxconn     = pool_conf.get('maxconn', 10),
+                        timeout     = pool_conf.get('timeout', 30),
+                        check_after = pool_conf.get('check_after', 30))
+        # schema registry: tables known to exist, so data queries don't have to ask the db first.
+        #   Filled by check_table at startup, invalidated by add_table/drop_table and "undefined table" errors
+        self.known_tables = set()
+        # create the missing (managed) tables and migrate the others, unless db.yaml
+        #   leaves migrating to `python src/db.py`
+        if migrate is None:
+            migrate = conf.get('migrate_on_start', True)
+        if migrate:
+            self.migrate()
         
     def connect(self):
-        with open(os.path.dirname(__file__) + "/../db.yaml", 'r') as settings_file:
-            conf = yaml.load(settings_file)
+        """ Open a standalone (unpooled) connection """
         try:
-            conn = psycopg2.connect(
-                            database = conf['database']['name'],
-                            user     = conf['database']['user'],
-                            password = conf['database']['pass'],
-                            host     = conf['database']['host'],
-                            port     = conf['database']['port'])
-         
-            return conn
+            metrics.count('db_connections_opened_total')
+            return psycopg2.connect(**self.settings)
         except psycopg2.Error as e:
             print("!! Error connecting to db")
             print(e)
             return None
+
+    @contextmanager
+    def cursor(self, autocommit=False):
+        """ Check out a pooled connection and yield a cursor, committing on success.
+            With autocommit, every statement commits by itself (i.e. for CREATE INDEX CONCURRENTLY) """
+        conn = self.pool.getconn()
+        broken = False
+        try:
+            if autocommit:
+                conn.autocommit = True
+            with metrics.stage('db'):
+                yield conn.cursor(cursor_factory=CountingCursor)
+                if not autocommit:
+                    conn.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # The connection itself failed, don't hand it out again
+            broken = True
+            raise
+        except BaseException as e:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+            if getattr(e, 'pgcode', None) == psycopg2.errorcodes.UNDEFINED_TABLE:
+                # A table went away behind our back, forget what we know
+                self.known_tables.clear()
+            raise
+        finally:
+            if autocommit and not broken:
+                try:
+                    conn.autocommit = False
+                except psycopg2.Error:
+                    broken = True
+            self.pool.putconn(conn, broken)
+
+    def close(self):
+        """ Close all the pooled connections """
+        self.pool.closeall()
+
+    def notify(self,channel,payload):
+        # Send a NOTIFY to every process LISTENing on channel (see listen)
+        try:
+            with self.cursor() as cur:
+                cur.execute("SELECT pg_notify(%s, %s)", (channel, payload))
+            return True
+        except psycopg2.Error as e:
+            print("!! Error notifying channel: %s" % channel)
+            print(e)
+            return False
+
+    def listen(self,channel,callback):
+        # Call callback(payload) from a background thread for each NOTIFY on channel.
+        #   Uses its own connection, reopened if it drops
+        def run():
+            while True:
+                conn = self.connect()
+                if conn is None:
+                    time.sleep(5)
+                    continue
+                try:
+                    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                    conn.cursor().execute("LISTEN %s;" % identifier(channel))
+                    while True:
+                        if select.select([conn], [], [], 60) != ([], [], []):
+                            conn.poll()
+                            while conn.notifies:
+                                try:
+                                    callback(conn.notifies.pop(0).payload)
+                                except Exception as e:
+                                    print("!! Error handling notification on channel: %s" % channel)
+                                    print(e)
+                except (psycopg2.Error, OSError) as e:
+                    print("!! Lost listening connection for channel: %s" % channel)
+                    print(e)
+                    time.sleep(1)
+                finally:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+        thread = threading.Thread(target=run, name='db-listen-' + channel)
+        thread.daemon = True
+        thread.start()
+        return thread
     
     def add_table(self,table_name,table_info):
         # table_info should follow proper sql format.
@@ -62,11 +357,10 @@ class DB:
         print(".. Creating table: %s...\n  Schema: %s" % (table_name, table_info))
         try:
             if not self.check_table(table_name):
-                conn = self.connect()
-                cur = conn.cursor()
-                SQL = "CREATE TABLE IF NOT EXISTS %s (%s);" % (table_name,table_info)
-                cur.execute(SQL)
-                conn.commit()
+                with self.cursor() as cur:
+                    SQL = "CREATE TABLE IF NOT EXISTS %s (%s);" % (table_name,table_info)
+                    cur.execute(SQL)
+                self.known_tables.add(table_name)
                 return True
             else:
                 print("!! Error creating table %s. Already exists" % table_name)
@@ -75,20 +369,14 @@ class DB:
             print("!! Error creating new table: %s" % table_name)
             print(e)
             return False
-        finally:
-            try:
-                conn.close()
-            except Exception:
-                pass
         
     def drop_table(self,table_name):
         try:
             if self.check_table(table_name):
-                conn = self.connect()
-                cur = conn.cursor()
-                SQL = "DROP TABLE IF EXISTS %s" % table_name
-                cur.execute(SQL)
-                conn.commit()
+                with self.cursor() as cur:
+                    SQL = "DROP TABLE IF EXISTS %s" % table_name
+                    cur.execute(SQL)
+                self.known_tables.discard(table_name)
                 return True
             else:
                 print("There is no table: %s" % table_name)
@@ -97,23 +385,16 @@ class DB:
             print("!! Error dropping table: %s" % table_name)
             print(e)
             return False
-        finally:
-            try:
-                conn.close()
-            except Exception:
-                pass
 
     def add_data(self,table_name,data):
         try:
-            if self.check_table(table_name):
-                conn = self.connect()
-                cur = conn.cursor()
-                columns = list(data.keys())
-                values = list(data.values())
-                second = ("%s, " * len(columns))[:-2]
-                SQL = "INSERT INTO {0} ({1}) VALUES ({2});".format(table_name, ", ".join(columns), second)
-                cur.execute(SQL, tuple(values))
-                conn.commit()
+            if self.has_table(table_name):
+                with self.cursor() as cur:
+                    columns = [identifier(c) for c in data.keys()]
+                    values = list(data.values())
+                    second = ("%s, " * len(columns))[:-2]
+                    SQL = "INSERT INTO {0} ({1}) VALUES ({2});".format(identifier(table_name), ", ".join(columns), second)
+                    cur.execute(SQL, tuple(values))
                 return True
             else:
                 print("There is no table: %s" % table_name)
@@ -122,62 +403,287 @@ class DB:
             print("!! Error adding data to table: %s" % table_name)
             print(e)
             return False
-        finally:
-            try:
-                conn.close()
-            except Exception:
-                pass
+
+    def add_unique(self,table_name,data):
+        # Like add_data, but raises DuplicateKey if a unique column (i.e. the primary key) is already taken,
+        #   so the caller can pick another key and retry without checking beforehand
+        try:
+            if self.has_table(table_name):
+                with self.cursor() as cur:
+                    columns = [identifier(c) for c in data.keys()]
+                    values = list(data.values())
+                    second = ("%s, " * len(columns))[:-2]
+                    SQL = "INSERT INTO {0} ({1}) VALUES ({2});".format(identifier(table_name), ", ".join(columns), second)
+                    cur.execute(SQL, tuple(values))
+                return True
+            else:
+                print("There is no table: %s" % table_name)
+                return False
+        except psycopg2.Error as e:
+            if e.pgcode == psycopg2.errorcodes.UNIQUE_VIOLATION:
+                raise DuplicateKey(str(e))
+            print("!! Error adding data to table: %s" % table_name)
+            print(e)
+            return False
+
+    def add_many(self,table_name,rows,page_size=500,ignore_duplicates=False):
+        # Bulk insert a list of dicts (all with the same keys) in one transaction,
+        #   sending page_size rows per INSERT statement. With ignore_duplicates, rows
+        #   violating a unique constraint are skipped
+        rows = list(rows)
+        if not rows:
+            return True
+        try:
+            if self.has_table(table_name):
+                keys = list(rows[0].keys())
+                columns = [identifier(c) for c in keys]
+                placeholders = "(" + ("%s, " * len(columns))[:-2] + ")"
+                with self.cursor() as cur:
+                    for start in range(0, len(rows), page_size):
+                        page = rows[start:start + page_size]
+                        values = b", ".join(cur.mogrify(placeholders, tuple(row[k] for k in keys)) for row in page)
+                        SQL = "INSERT INTO {0} ({1}) VALUES ".format(identifier(table_name), ", ".join(columns))
+                        if ignore_duplicates:
+                            values += b" ON CONFLICT DO NOTHING"
+                        cur.execute(SQL.encode('utf-8') + values)
+                return True
+            else:
+                print("There is no table: %s" % table_name)
+                return False
+        except psycopg2.Error as e:
+            print("!! Error adding data to table: %s" % table_name)
+            print(e)
+            return False
+
+    def upsert_data(self,table_name,data,key_column='id'):
+        # Insert a row, or update it in place if a row with the same key_column exists.
+        #   A single INSERT ... ON CONFLICT statement (needs PostgreSQL >= 9.5), so readers never see the row missing
+        try:
+            if self.has_table(table_name):
+                with self.cursor() as cur:
+                    columns = [identifier(c) for c in data.keys()]
+                    values = list(data.values())
+                    second = ("%s, " * len(columns))[:-2]
+                    updates = ", ".join("{0} = EXCLUDED.{0}".format(c) for c in columns if c != key_column)
+                    SQL = "INSERT INTO {0} ({1}) VALUES ({2}) ON CONFLICT ({3}) ".format(
+                        identifier(table_name), ", ".join(columns), second, identifier(key_column))
+                    if updates:
+                        SQL += "DO UPDATE SET " + updates + ";"
+                    else:
+                        SQL += "DO NOTHING;"
+                    cur.execute(SQL, tuple(values))
+                return True
+            else:
+                print("There is no table: %s" % table_name)
+                return False
+        except psycopg2.Error as e:
+            print("!! Error upserting data in table: %s" % table_name)
+            print(e)
+            return False
             
-    def get_data(self,table_name,condition_column_name,condition_value):
+    def add_reference(self,table_name,data,key_column,count_column,insert=True):
+        # Count one more reference to a row, inserting data (with a count of 1) if the row is missing.
+        #   The row is only sent if it isn't already there. Returns the references now (1 if the row
+        #   was just added), False on errors. Without insert, a missing row is left missing and 0 returned
         try:
-            if self.check_table(table_name):
-                conn = self.connect()
-                cur = conn.cursor()
-                SQL = "SELECT * FROM %s WHERE %s = '%s'" % (table_name,condition_column_name,condition_value)
-                cur.execute(SQL)
-                response = cur.fetchall()
-                return response
+            if self.has_table(table_name):
+                with self.cursor() as cur:
+                    table, key, count = identifier(table_name), identifier(key_column), identifier(count_column)
+                    SQL = "UPDATE {0} SET {2} = {2} + 1 WHERE {1} = %s RETURNING {2}".format(table, key, count)
+                    cur.execute(SQL, (data[key_column], ))
+                    row = cur.fetchone()
+                    if row is None and not insert:
+                        return 0
+                    if row is None:
+                        columns = [identifier(c) for c in data.keys()]
+                        second = ("%s, " * len(columns))
+                        SQL = ("INSERT INTO {0} ({3}, {2}) VALUES ({4}1) ON CONFLICT ({1}) " +
+                               "DO UPDATE SET {2} = {0}.{2} + 1 RETURNING {2}").format(table, key, count, ", ".join(columns), second)
+                        cur.execute(SQL, tuple(data.values()))
+                        row = cur.fetchone()
+                return row[0]
+            else:
+                print("There is no table: %s" % table_name)
+                return False
+        except psycopg2.Error as e:
+            print("!! Error adding reference in table: %s" % table_name)
+            print(e)
+            return False
+
+    def drop_reference(self,table_name,key_column,key_value,count_column,cascade=()):
+        # Count one less reference to a row, deleting it when none are left, along with the rows of the
+        #   (table, column) pairs in cascade holding its key, in the same transaction. Returns the references left
+        try:
+            if self.has_table(table_name):
+                with self.cursor() as cur:
+                    return self.__drop_reference(cur, table_name, key_column, key_value, count_column, cascade)
+            else:
+                return None
+        except psycopg2.Error as e:
+            print("!! Error dropping reference in table: %s" % table_name)
+            print(e)
+            return None
+
+    def __drop_reference(self, cur, table_name, key_column, key_value, count_column, cascade):
+        table, key, count = identifier(table_name), identifier(key_column), identifier(count_column)
+        # Locks the row, so a concurrent add_reference waits and then inserts it again
+        SQL = "UPDATE {0} SET {2} = {2} - 1 WHERE {1} = %s RETURNING {2}".format(table, key, count)
+        cur.execute(SQL, (key_value, ))
+        row = cur.fetchone()
+        if row is None:
+            return 0
+        if row[0] <= 0:
+            SQL = "DELETE FROM {0} WHERE {1} = %s AND {2} <= 0".format(table, key, count)
+            cur.execute(SQL, (key_value, ))
+            for other_table, column in cascade:
+                cur.execute("DELETE FROM {0} WHERE {1} = %s".format(identifier(other_table), identifier(column)), (key_value, ))
+            return 0
+        return row[0]
+
+    def delete_paste(self, id):
+        # Delete a paste and drop its reference to its content in the same transaction, deleting the
+        #   content and its chunks when no other paste has it. Only a paste actually deleted drops one,
+        #   so deleting it twice (a double click, the expiry of every worker process) can't take the
+        #   content of another paste. Returns (content hash, references left), None if the paste
+        #   wasn't there, False on errors
+        try:
+            with self.cursor() as cur:
+                cur.execute("DELETE FROM pastes WHERE id = %s RETURNING content_hash", (id, ))
+                row = cur.fetchone()
+                if row is None:
+                    return None
+                if not row[0]:
+                    return (None, 0)
+                return (row[0], self.__drop_reference(cur, 'blobs', 'hash', row[0], 'refs', [('chunks', 'hash')]))
+        except psycopg2.Error as e:
+            print("!! Error deleting paste: %s" % id)
+            print(e)
+            return False
+
+    def get_data(self,table_name,condition_column_name,condition_value,columns=None):
+        # columns: optional list of column names to fetch instead of all of them
+        try:
+            if self.has_table(table_name):
+                with self.cursor() as cur:
+                    selected = ", ".join(identifier(c) for c in columns) if columns else "*"
+                    SQL = "SELECT %s FROM %s WHERE %s = %%s" % (selected,identifier(table_name),identifier(condition_column_name))
+                    cur.execute(SQL, (condition_value, ))
+                    return cur.fetchall()
             else:
                 return None
         except psycopg2.Error as e:
             print("!! Error retrieving data from table: %s" % table_name)
             print(e)
             return None
-        finally:
-            try:
-                conn.close()
-            except Exception:
-                pass
 
-    def get_all_data(self,table_name):
+    def get_all_data(self,table_name,columns=None):
+        # columns: optional list of column names to fetch instead of all of them
         try:
-            if self.check_table(table_name):
-                conn = self.connect()
-                cur = conn.cursor()
-                SQL = "SELECT * FROM %s" % (table_name)
-                cur.execute(SQL)
-                response = cur.fetchall()
-                return response
+            if self.has_table(table_name):
+                with self.cursor() as cur:
+                    selected = ", ".join(identifier(c) for c in columns) if columns else "*"
+                    SQL = "SELECT %s FROM %s" % (selected,identifier(table_name))
+                    cur.execute(SQL)
+                    return cur.fetchall()
             else:
                 return None
         except psycopg2.Error as e:
             print("!! Error retrieving data from table: %s" % table_name)
             print(e)
             return None
-        finally:
-            try:
-                conn.close()
-            except Exception:
-                pass
+
+    def index_text(self,table_name,key_column,key_value,column,text):
+        # Set a tsvector column of a row from text, for full text search
+        try:
+            if self.has_table(table_name):
+                with self.cursor() as cur:
+                    SQL = "UPDATE %s SET %s = to_tsvector(%%s, %%s) WHERE %s = %%s" % (
+                        identifier(table_name), identifier(column), identifier(key_column))
+                    cur.execute(SQL, (SEARCH_CONFIG, text[:SEARCH_MAX_CHARS], key_value))
+                return True
+            else:
+                return False
+        except psycopg2.Error as e:
+            print("!! Error indexing text in table: %s" % table_name)
+            print(e)
+            return False
+
+    def list_pastes(self,columns,filters=None,since=None,until=None,text=None,after=None,limit=50):
+        # Newest pastes first, with keyset pagination on (created_at, id): pass the last row's
+        #   (created_at, id) as `after` to get the next page.
+        #   filters: {column: value} equalities, since/until: created_at range, text: full text search query
+        try:
+            if self.has_table('pastes'):
+                with self.cursor() as cur:
+                    conditions, values = [], []
+                    for column, value in sorted((filters or {}).items()):
+                        conditions.append("%s = %%s" % identifier(column))
+                        values.append(value)
+                    if since is not None:
+                        conditions.append("created_at >= %s")
+                        values.append(since)
+                    if until is not None:
+                        conditions.append("created_at < %s")
+                        values.append(until)
+                    if text:
+                        conditions.append("content_hash IN (SELECT hash FROM blobs WHERE search @@ plainto_tsquery(%s, %s))")
+                        values.extend((SEARCH_CONFIG, text))
+                    if after is not None:
+                        conditions.append("(created_at, id) < (%s, %s)")
+                        values.extend(after)
+                    SQL = "SELECT %s FROM pastes" % ", ".join(identifier(c) for c in columns)
+                    if conditions:
+                        SQL += " WHERE " + " AND ".join(conditions)
+                    SQL += " ORDER BY created_at DESC, id DESC LIMIT %s"
+                    values.append(limit)
+                    cur.execute(SQL, tuple(values))
+                    return cur.fetchall()
+            else:
+                return None
+        except psycopg2.Error as e:
+            print("!! Error listing pastes")
+            print(e)
+            return None
+
+    def get_chunks(self,content_hash,first,last):
+        # Chunks first to last (inclusive) of a chunked content, as (number, content) rows in order
+        try:
+            with self.cursor() as cur:
+                cur.execute("SELECT number, content FROM chunks WHERE hash = %s AND number BETWEEN %s AND %s " +
+                            "ORDER BY number", (content_hash, first, last))
+                return cur.fetchall()
+        except psycopg2.Error as e:
+            print("!! Error retrieving chunks of: %s" % content_hash)
+            print(e)
+            return None
+
+    def take_token(self,table_name,bucket,rate,burst):
+        # Token bucket rate limiting: refill a bucket for the time since its last use (rate tokens per
+        #   second, up to burst) and take a token from it. The row stays locked in between, so concurrent
+        #   requests queue. Returns 0, or the seconds until a token is available; None on errors
+        try:
+            with self.cursor() as cur:
+                table = identifier(table_name)
+                SQL = ("INSERT INTO {0} (bucket, tokens, updated) VALUES (%s, %s, now()) ON CONFLICT (bucket) " +
+                       "DO UPDATE SET tokens = LEAST(%s, {0}.tokens + %s * EXTRACT(EPOCH FROM now() - {0}.updated)), " +
+                       "updated = now() RETURNING tokens").format(table)
+                cur.execute(SQL, (bucket, burst, burst, rate))
+                tokens = cur.fetchone()[0]
+                if tokens < 1:
+                    return (1 - tokens) / rate
+                cur.execute("UPDATE {0} SET tokens = tokens - 1 WHERE bucket = %s".format(table), (bucket, ))
+                return 0
+        except psycopg2.Error as e:
+            print("!! Error taking a token in table: %s" % table_name)
+            print(e)
+            return None
 
     def delete_data(self,table_name,condition_column_name,condition_value):
         try:
-            if self.check_table(table_name):
-                conn = self.connect()
-                cur = conn.cursor()
-                SQL = "DELETE FROM %s WHERE %s = '%s'" % (table_name,condition_column_name,condition_value)
-                cur.execute(SQL)
-                conn.commit()
+            if self.has_table(table_name):
+                with self.cursor() as cur:
+                    SQL = "DELETE FROM %s WHERE %s = %%s" % (identifier(table_name),identifier(condition_column_name))
+                    cur.execute(SQL, (condition_value, ))
                 return True
             else:
                 print("There is no table: %s" % table_name)
@@ -186,20 +692,13 @@ class DB:
             print("!! Error deleting data from table: %s" % table_name)
             print(e)
             return False
-        finally:
-            try:
-                conn.close()
-            except Exception:
-                pass
 
     def update_data(self,table_name,column_name,changed_value,condition_column_name,condition_value):
         try:
-            if self.check_table(table_name):
-                conn = self.connect()
-                cur = conn.cursor()
-                SQL = "UPDATE "+table_name+" SET "+column_name+" = %s WHERE "+condition_column_name+" = "+condition_value
-                cur.execute(SQL, (changed_value))
-                conn.commit()
+            if self.has_table(table_name):
+                with self.cursor() as cur:
+                    SQL = "UPDATE "+identifier(table_name)+" SET "+identifier(column_name)+" = %s WHERE "+identifier(condition_column_name)+" = %s"
+                    cur.execute(SQL, (changed_value, condition_value))
                 return True
             else:
                 print("There is no table: %s" % table_name)
@@ -208,83 +707,217 @@ class DB:
             print("!! Error updating data in table: %s" % table_name)
             print(e)
             return False
-        finally:
-            try:
-                conn.close()
-            except Exception:
-                pass
+
+    def has_table(self,table_name):
+        # Answer from the schema registry, only asking the db about tables we haven't seen yet
+        if table_name in self.known_tables:
+            return True
+        return self.check_table(table_name)
+
+    def delete_older_than(self,table_name,column_name,value):
+        # Delete the rows whose column_name is lower than value
+        try:
+            if self.has_table(table_name):
+                with self.cursor() as cur:
+                    SQL = "DELETE FROM %s WHERE %s < %%s" % (identifier(table_name),identifier(column_name))
+                    cur.execute(SQL, (value, ))
+                    return cur.rowcount
+            else:
+                print("There is no table: %s" % table_name)
+                return 0
+        except psycopg2.Error as e:
+            print("!! Error deleting data from table: %s" % table_name)
+            print(e)
+            return 0
+
+    def count_data(self,table_name,condition_column_name=None,condition_value=None):
+        # Count the rows of a table, or the ones with condition_value in condition_column_name
+        try:
+            if self.has_table(table_name):
+                with self.cursor() as cur:
+                    if condition_column_name is None:
+                        cur.execute("SELECT count(*) FROM %s" % identifier(table_name))
+                    else:
+                        SQL = "SELECT count(*) FROM %s WHERE %s = %%s" % (identifier(table_name),identifier(condition_column_name))
+                        cur.execute(SQL, (condition_value, ))
+                    return cur.fetchone()[0]
+            else:
+                return 0
+        except psycopg2.Error as e:
+            print("!! Error counting rows of table: %s" % table_name)
+            print(e)
+            return 0
 
     def check_table(self,table_name):
+        # Always asks the db, and refreshes the schema registry with the answer
         try:
-            conn = self.connect()
-            cur = conn.cursor()
-            SQL = "SELECT EXISTS(SELECT * FROM information_schema.tables WHERE table_name=%s)"
-            data = (table_name, )
-            cur.execute(SQL, data)
-            response = cur.fetchone()[0]
-            if not response:
+            with self.cursor() as cur:
+                SQL = "SELECT EXISTS(SELECT * FROM information_schema.tables WHERE table_name=%s)"
+                data = (table_name, )
+                cur.execute(SQL, data)
+                response = cur.fetchone()[0]
+            if response:
+                self.known_tables.add(table_name)
+            else:
+                self.known_tables.discard(table_name)
                 print("!! DB Table not exists: %s" % table_name)
             return response
         except psycopg2.Error as e:
             print("!! Error checking table exists: %s  [ironic, right?]" % table_name)
             print(e)
             return False    ##ASK Really want to return False on fail here?? Table may actually exist.
+
+    def has_column(self, table_name, column_name):
+        try:
+            with self.cursor() as cur:
+                SQL = "SELECT EXISTS(SELECT * FROM information_schema.columns WHERE table_name=%s AND column_name=%s)"
+                cur.execute(SQL, (table_name, column_name))
+                return cur.fetchone()[0]
+        except psycopg2.Error as e:
+            print("!! Error checking column exists: %s.%s" % (table_name, column_name))
+            print(e)
+            return False
+
+    def add_indexes(self, table_name):
+        # Create the indexes of a table listed in DB.indexes, if they're missing
+        try:
+            with self.cursor() as cur:
+                for name, definition in DB.indexes.get(table_name, ()):
+                    cur.execute("CREATE INDEX IF NOT EXISTS %s ON %s %s" % (identifier(name), identifier(table_name), definition))
+            return True
+        except psycopg2.Error as e:
+            print("!! Error creating indexes of table: %s" % table_name)
+            print(e)
+            return False
+
+    def get_version(self, table_name):
+        # Version of a managed table as recorded in the versions table
+        rows = self.get_data(DB.versions_table[0], 'table_name', table_name, columns=('version', ))
+        if rows:
+            return rows[0][0]
+        return 1
+
+    def set_version(self, table_name, version):
+        return self.upsert_data(DB.versions_table[0], {'table_name': table_name, 'version': version}, 'table_name')
+
+    def index_valid(self, index_name):
+        # True if the index exists and is usable, False if it's left invalid by a failed
+        #   CREATE INDEX CONCURRENTLY, None if it doesn't exist
+        with self.cursor() as cur:
+            cur.execute("SELECT i.indisvalid FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid " +
+                        "WHERE c.relname = %s", (index_name, ))
+            row = cur.fetchone()
+            return row[0] if row else None
+
+    def create_table(self, table_name):
+        # Create a missing table at its latest version, with its indexes
+        if not self.add_table(table_name, DB.tables[table_name][1]):
+            return False
+        self.add_indexes(table_name)
+        self.set_version(table_name, DB.tables[table_name][0])
+        return True
+
+    def pending_migrations(self):
+        """ List the (table, version, description, steps) still to run, in order """
+        pending = []
+        for table in DB.tables:
+            if table in DB.unmanaged_tables or not self.check_table(table):
+                continue
+            new_version = DB.tables[table][0]
+            for version in range(self.get_version(table) + 1, new_version + 1):
+                description, steps = migrations.MIGRATIONS.get(table, {}).get(version, (None, None))
+                pending.append((table, version, description, steps))
+        return pending
+
+    @contextmanager
+    def advisory_lock(self, key, poll=1.0):
+        """ Hold a (session level) advisory lock, waiting for the process holding it. It has
+            a connection of its own, closing it releases the lock """
+        conn = self.connect()
+        if conn is None:
+            raise psycopg2.OperationalError("Could not connect to take advisory lock %d" % key)
+        try:
+            conn.autocommit = True
+            cur = conn.cursor()
+            # Polled rather than waited for with pg_advisory_lock: a waiting statement holds a snapshot,
+            #   which the holder's CREATE INDEX CONCURRENTLY would wait for in turn, a deadlock
+            #   postgres can't see
+            waiting = False
+            while True:
+                cur.execute("SELECT pg_try_advisory_lock(%s)", (key, ))
+                if cur.fetchone()[0]:
+                    break
+                if not waiting:
+                    print(".. Waiting for another process to finish migrating...")
+                    waiting = True
+                time.sleep(poll)
+            yield
         finally:
-            try:
-                conn.close()
-            except Exception:
-                pass
+            conn.close()
 
-    def __ensure_all_tables_correct(self):
-        all_tables = DB.tables.keys()
-        all_successful = True
+    def migrate(self, dry_run=False):
+        """ Create the missing tables and migrate the others to their version in DB.tables,
+            one process at a time. A dry run only prints what would be done """
+        if dry_run:
+            return self.__migrate(dry_run)
+        try:
+            with self.advisory_lock(migrations.ADVISORY_LOCK):
+                return self.__migrate(dry_run)
+        except psycopg2.Error as e:
+            print("!! Error migrating tables")
+            print(e)
+            return False
+
+    def __migrate(self, dry_run):
         print(".. Checking all tables...")
-        for table in all_tables:
-            if table in DB.unmanaged_tables:
+        if not self.check_table(DB.versions_table[0]):
+            if dry_run:
+                print(".. Would create table: %s" % DB.versions_table[0])
+            else:
+                self.add_table(*DB.versions_table)
+        all_successful = True
+        for table in DB.tables:
+            if table in DB.unmanaged_tables or self.check_table(table):
                 continue
-            if self.__ensure_table_correct(table):
-                print(".. Table found: %s" % table)
+            if dry_run:
+                print(".. Would create table: %s" % table)
+            elif self.create_table(table):
+                print(".. Created table: %s" % table)
             else:
-                print("!! Table not found: %s" % table)
-                if self.__recreate_table(table):
-                    print(".. Created table: %s" % table)
-                else:
-                    print("!! Failed to create table: %s" % table)
-                    all_successful = False
-        return all_successful
-    
-    def __ensure_table_correct(self, table_name):
-        # TODO Test old/new version numbers and trigger __on_upgrade, __recreate etc etc
-        #   For now we'll just test if table exists
-        return self.check_table(table_name)
-    
-    def __recreate_table(self, table_name):
-        go_for_new = False
-        if self.check_table(table_name):
-            if self.drop_table(table_name):
-                go_for_new = True
-        else:
-            go_for_new = True
-        
-        if go_for_new:
-            if self.add_table(table_name, self.tables[table_name][1]):
-                return True
-        return False
-    
-    
-    def __on_upgrade(self, table_name, new_version, old_version=0):
-        # Can eventually handle upgrades to tables without losing data
-        #     by making use of the version numbers
-        # For now just destroy and recreate the tables
-        # Skipping the projects table to retain info
-        
-        if table_name == 'pastes':
-            return self.__recreate_table('pastes')
-        
-        else:
-            print("Unsupported table: %s. Add to db.tables and db.__on_upgrade to deploy")
-            return False
-        
-        
+                print("!! Failed to create table: %s" % table)
+                all_successful = False
+        failed = set()
+        for table, version, description, steps in self.pending_migrations():
+            if table in failed:
+                continue
+            if steps is None:
+                # Tables (and their data) are never dropped to bring them up to date
+                print("!! No migration of table %s to version %d, add it to migrations.MIGRATIONS" % (table, version))
+                failed.add(table)
+                continue
+            print(".. %s table %s to version %d: %s" % ("Would migrate" if dry_run else "Migrating", table, version, description))
+            try:
+                for step in steps:
+                    if not step.pending(self):
+                        continue
+                    print("..   " + step.describe())
+                    if not dry_run:
+                        step.run(self)
+                if not dry_run:
+                    self.set_version(table, version)
+            except psycopg2.Error as e:
+                print("!! Error migrating table %s to version %d" % (table, version))
+                print(e)
+                failed.add(table)
+        return all_successful and not failed
+
+
 if __name__ == "__main__":
-    pass
+    import argparse
+    parser = argparse.ArgumentParser(description="Create and migrate the tables of the db in db.yaml")
+    parser.add_argument('--dry-run', action='store_true', help="only print what would be done")
+    args = parser.parse_args()
+    db = DB(migrate=False)
+    success = db.migrate(dry_run=args.dry_run)
+    db.close()
+    raise SystemExit(0 if success else 1)
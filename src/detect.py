@@ -0,0 +1,122 @@
+#!/usr/bin/python3.4
+import json
+import os.path
+import re
+import pygments.lexers
+from pygments.util import ClassNotFound
+
+# Only this many characters of a paste are looked at
+SAMPLE_SIZE = 8192
+
+# Detection only picks from the languages offered in the new paste form
+LANGUAGES_FILE = os.path.join(os.path.dirname(__file__), "..", "languages.json")
+
+# Interpreter (from the shebang line, without version numbers) -> language
+INTERPRETERS = {
+    'python': 'py3',
+    'python2': 'py',
+    'python3': 'py3',
+    'ruby': 'rb',
+    'lua': 'lua',
+    'sh': 'sh',
+    'bash': 'sh',
+    'dash': 'sh',
+    'ksh': 'sh',
+    'zsh': 'sh',
+    'php': 'php',
+    'node': 'js',
+    'nodejs': 'js',
+}
+
+# Beginnings of content that identify a language
+SIGNATURES = (
+    ('<?php', 'php'),
+    ('<?xml', 'xml'),
+    ('<!doctype html', 'html'),
+    ('<html', 'html'),
+    ('Traceback (most recent call last):', 'py3tb'),
+    ('>>> ', 'pycon'),
+)
+
+MODELINE = re.compile(r"(?:vim?:.*?\b(?:ft|filetype|syntax)=(?P<vim>[\w+#-]+))|(?:-\*-\s*(?:mode:\s*)?(?P<emacs>[\w+#-]+)\s*(?:;.*?)?-\*-)")
+
+def load_languages():
+    """ Map each language of languages.json to its lexer class """
+    with open(LANGUAGES_FILE, 'r') as f:
+        names = json.load(f)
+    lexers = []
+    for alias in names:
+        try:
+            lexers.append((alias, type(pygments.lexers.get_lexer_by_name(alias))))
+        except ClassNotFound:
+            pass
+    return lexers
+
+languages = load_languages()
+
+def detect(content):
+    """ Return the language (a languages.json key) to highlight content with """
+    sample = content[:SAMPLE_SIZE]
+    return by_signature(sample) or by_analysis(sample)
+
+def by_signature(sample):
+    """ Look for cheap, reliable hints: shebang lines, editor modelines and known file beginnings """
+    lines = sample.splitlines()
+    if not lines:
+        return 'text'
+    # Shebang
+    if lines[0].startswith('#!'):
+        words = lines[0][2:].split()
+        if words and words[0].endswith('/env') and len(words) > 1:
+            words = words[1:]
+        if words:
+            # python3.4 -> python3 -> python
+            name = os.path.basename(words[0])
+            for candidate in (name, re.sub(r"\.[\d.]*$", "", name), re.sub(r"[\d.]+$", "", name)):
+                if candidate in INTERPRETERS:
+                    return INTERPRETERS[candidate]
+    # Vim or emacs modeline, in the first or last lines
+    for line in lines[:5] + lines[-5:]:
+        match = MODELINE.search(line)
+        if match:
+            alias = for_lexer(match.group('vim') or match.group('emacs'))
+            if alias:
+                return alias
+    # Known file beginnings
+    start = sample.lstrip()
+    for signature, alias in SIGNATURES:
+        if start[:len(signature)].lower() == signature.lower():
+            return alias
+    # Small JSON documents can just be parsed
+    if start[:1] in ('{', '[') and len(sample) < SAMPLE_SIZE:
+        try:
+            json.loads(sample)
+            return 'json'
+        except ValueError:
+            pass
+    return None
+
+def by_analysis(sample):
+    """ Ask each candidate lexer how likely the sample is in its language """
+    best, best_score = 'text', 0.0
+    for alias, lexer in languages:
+        try:
+            score = lexer.analyse_text(sample)
+        except Exception:
+            continue
+        if score > best_score:
+            best, best_score = alias, score
+            if score >= 1.0:
+                break
+    return best
+
+def for_lexer(name):
+    """ Return the languages.json key highlighted by the same lexer as `name` """
+    try:
+        lexer = type(pygments.lexers.get_lexer_by_name(name.lower()))
+    except ClassNotFound:
+        return None
+    for alias, candidate in languages:
+        if candidate is lexer:
+            return alias
+    return None
@@ -0,0 +1,91 @@
+#!/usr/bin/python3.4
+import heapq
+import threading
+import time
+
+class ExpiryScheduler:
+    """ Expires temporary pastes from a single background thread
+
+    Deadlines are kept in a heap ordered by time. Cancelling or rescheduling
+    a paste only updates `deadlines`; stale heap entries are skipped when
+    they come up.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback # Called with the paste id once its deadline has passed
+        self.heap = []           # (deadline, id) pairs
+        self.deadlines = {}      # id -> current deadline
+        self.cond = threading.Condition()
+        self.running = False
+        self.thread = None
+        self.expired = 0
+
+    def start(self):
+        """ Start the scheduler thread """
+        with self.cond:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target=self.__run, name='paste-expiry')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """ Stop the scheduler thread """
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def schedule(self, id, deadline):
+        """ Expire the paste `id` at `deadline` (a unix timestamp), replacing any previous deadline """
+        with self.cond:
+            self.deadlines[id] = deadline
+            heapq.heappush(self.heap, (deadline, id))
+            # Drop stale entries once they outnumber the live ones
+            if len(self.heap) > 2 * len(self.deadlines) + 64:
+                self.heap = [(d, i) for i, d in self.deadlines.items()]
+                heapq.heapify(self.heap)
+            # Wake up the thread in case this is the new earliest deadline
+            self.cond.notify()
+
+    def cancel(self, id):
+        """ Forget the deadline of the paste `id` """
+        with self.cond:
+            self.deadlines.pop(id, None)
+
+    def depth(self):
+        """ Return how many pastes are waiting to expire """
+        with self.cond:
+            return len(self.deadlines)
+
+    def __due(self):
+        """ Wait for deadlines to pass and return the expired ids """
+        with self.cond:
+            while self.running:
+                now = time.time()
+                due = []
+                while self.heap and self.heap[0][0] <= now:
+                    deadline, id = heapq.heappop(self.heap)
+                    if self.deadlines.get(id) == deadline:
+                        del self.deadlines[id]
+                        due.append(id)
+                if due:
+                    return due
+                self.cond.wait(self.heap[0][0] - now if self.heap else None)
+            return []
+
+    def __run(self):
+        while self.running:
+            for id in self.__due():
+                try:
+                    self.callback(id)
+                    self.expired += 1
+                except Exception as e:
+                    print("!! Error expiring paste '{0}'".format(id))
+                    print(e)
+
+    def __repr__(self):
+        return '<Expiry scheduler, {0} pending>'.format(self.depth())
@@ -0,0 +1,138 @@
+#!/usr/bin/python3.4
+# Counters and stage timings, exposed in the Prometheus text format by /metrics.
+#
+# Code runs the interesting parts of a request inside stage("db"),
+# stage("template"), ... which adds their time both to the process totals and
+# to the breakdown of the request being served (by this thread). Stages can
+# nest: db queries made while rendering a template count in both.
+import collections
+import contextlib
+import functools
+import threading
+import time
+
+# Requests slower than this are logged with their stage breakdown (None to disable),
+# set from slow_request_ms in pasteit.conf
+SLOW_REQUEST_SECONDS = None
+# Whether anyone can read /metrics, otherwise only a session with the master password.
+#   Set from metrics_public in pasteit.conf
+PUBLIC = False
+
+lock = threading.Lock()
+counters = collections.defaultdict(int)           # (name, labels) -> value
+stages = collections.defaultdict(lambda: [0, 0.0]) # stage -> [count, seconds]
+collectors = []                                    # functions returning the current value of gauges
+current = threading.local()                        # breakdown of the request served by this thread
+
+def configure(config):
+    """ Read the slow request threshold and who can read /metrics from the [pasteit] config section """
+    global SLOW_REQUEST_SECONDS, PUBLIC
+    slow = config.get('slow_request_ms')
+    SLOW_REQUEST_SECONDS = slow / 1000.0 if slow else None
+    PUBLIC = bool(config.get('metrics_public', False))
+
+def count(name, value=1, **labels):
+    """ Increase a counter """
+    key = (name, tuple(sorted(labels.items())))
+    with lock:
+        counters[key] += value
+
+def observe(name, seconds):
+    """ Add time to a stage """
+    with lock:
+        entry = stages[name]
+        entry[0] += 1
+        entry[1] += seconds
+    breakdown = getattr(current, 'stages', None)
+    if breakdown is not None:
+        breakdown[name] = breakdown.get(name, 0.0) + seconds
+
+@contextlib.contextmanager
+def stage(name):
+    """ Time a block as a stage """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+def timed(name):
+    """ Decorator timing a function as a stage """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def note(key, value):
+    """ Attach a detail (i.e. the paste size) to the request served by this thread, for the slow log """
+    notes = getattr(current, 'notes', None)
+    if notes is not None:
+        notes[key] = value
+
+def begin():
+    """ Start timing a request served by this thread """
+    current.start = time.perf_counter()
+    current.stages = {}
+    current.notes = {}
+
+def end(method, path, status):
+    """ Finish timing the request served by this thread, logging it if it was slow """
+    start = getattr(current, 'start', None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    breakdown, notes = current.stages, current.notes
+    current.start = current.stages = current.notes = None
+    count('requests_total', status=str(status).split()[0])
+    observe('request', elapsed)
+    if SLOW_REQUEST_SECONDS is not None and elapsed >= SLOW_REQUEST_SECONDS:
+        details = ["{0} {1:.1f} ms".format(name, seconds * 1000) for name, seconds in sorted(breakdown.items())]
+        details += ["{0}={1}".format(key, value) for key, value in sorted(notes.items())]
+        print("!! Slow request: {0} {1} {2:.1f} ms ({3})".format(method, path, elapsed * 1000, ", ".join(details)))
+
+def register(collector):
+    """ Add a function returning (name, labels dict, value) tuples of gauges, called on every scrape """
+    collectors.append(collector)
+
+def cache(name, cache):
+    """ Export the statistics of an LRUCache """
+    def collect():
+        stats = cache.stats()
+        labels = {'cache': name}
+        return [('cache_entries', labels, stats['entries']),
+            ('cache_bytes', labels, stats['bytes']),
+            ('cache_hits_total', labels, stats['hits']),
+            ('cache_misses_total', labels, stats['misses']),
+            ('cache_evictions_total', labels, stats['evictions'])]
+    register(collect)
+
+def exposition():
+    """ Return every metric in the Prometheus text format """
+    samples = collections.OrderedDict() # name -> [(labels, value)]
+    with lock:
+        for (name, labels), value in sorted(counters.items()):
+            samples.setdefault(name, []).append((dict(labels), value))
+        for name, (number, seconds) in sorted(stages.items()):
+            samples.setdefault('stage_seconds_count', []).append(({'stage': name}, number))
+            samples.setdefault('stage_seconds_sum', []).append(({'stage': name}, seconds))
+    for collector in list(collectors):
+        try:
+            for name, labels, value in collector():
+                samples.setdefault(name, []).append((labels, value))
+        except Exception as e:
+            print("!! Error collecting metrics")
+            print(e)
+    lines = []
+    for name, values in samples.items():
+        if name.startswith('stage_seconds'):
+            if name == 'stage_seconds_count':
+                lines.append("# TYPE pasteit_stage_seconds summary")
+        else:
+            lines.append("# TYPE pasteit_{0} {1}".format(name, 'counter' if name.endswith('_total') else 'gauge'))
+        for labels, value in values:
+            label = ",".join('{0}="{1}"'.format(k, v) for k, v in sorted(labels.items()))
+            lines.append("pasteit_{0}{1} {2}".format(name, "{" + label + "}" if label else "", value))
+    return "\n".join(lines) + "\n"
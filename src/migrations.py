@@ -0,0 +1,298 @@
+#!/usr/bin/python3.4
+# Schema migrations of the managed tables in db.DB.tables.
+#
+# Bringing a table from version N-1 to N runs the steps listed under
+# MIGRATIONS[table][N], in order, then records N in the schema_version table.
+# Steps are written so they can run while the site is up, on big tables:
+#
+#   - DDL only does what PostgreSQL can do without rewriting the table (adding a
+#     nullable column, dropping one), under a short lock_timeout so it never
+#     queues the live queries behind it, retried if it can't get its lock
+#   - rows are changed by backfills, a batch of rows per transaction
+#   - indexes are built with CREATE INDEX CONCURRENTLY
+#
+# Every step is safe to run again, so an interrupted migration resumes from
+# the version it had reached. Processes starting together take turns (see
+# ADVISORY_LOCK): the first one migrates, the others find nothing left to do.
+# To see what would run without changing anything:
+#
+#     python src/db.py --dry-run
+import time
+import psycopg2
+import psycopg2.errorcodes
+import chunks
+import compression
+
+# How long DDL waits for its table lock before giving up (and retrying)
+LOCK_TIMEOUT = '5s'
+LOCK_RETRIES = 10
+# Rows changed per backfill transaction
+BATCH_SIZE = 500
+# Seconds to sleep between backfill batches, leaving the db some room for live traffic
+BATCH_PAUSE = 0.0
+# Key of the advisory lock held while migrating, so only one process (i.e. one of the
+#   worker processes starting together) migrates at a time, the others wait for it
+ADVISORY_LOCK = 0x70617374
+
+class Step:
+    """ One operation of a migration """
+
+    def __init__(self, skip=None):
+        # skip(db) returns True when the step has nothing (left) to do
+        self.skip = skip
+
+    def pending(self, db):
+        return self.skip is None or not self.skip(db)
+
+    def describe(self):
+        raise NotImplementedError
+
+    def run(self, db):
+        raise NotImplementedError
+
+class Statement(Step):
+    """ A quick DDL statement, run under LOCK_TIMEOUT """
+
+    def __init__(self, sql, skip=None):
+        Step.__init__(self, skip)
+        self.sql = sql
+
+    def describe(self):
+        return self.sql
+
+    def run(self, db):
+        for attempt in range(1, LOCK_RETRIES + 1):
+            try:
+                with db.cursor() as cur:
+                    cur.execute("SET LOCAL lock_timeout = %s", (LOCK_TIMEOUT, ))
+                    self.execute(cur)
+                return
+            except psycopg2.Error as e:
+                if e.pgcode != psycopg2.errorcodes.LOCK_NOT_AVAILABLE or attempt == LOCK_RETRIES:
+                    raise
+                print(".. Lock not available, retrying (%d/%d): %s" % (attempt, LOCK_RETRIES, self.sql))
+                time.sleep(attempt)
+
+    def execute(self, cur):
+        cur.execute(self.sql)
+
+class AddColumn(Statement):
+    """ Add a nullable column without a default, which doesn't rewrite the table """
+
+    def __init__(self, table_name, column, type):
+        Statement.__init__(self, "ALTER TABLE %s ADD COLUMN IF NOT EXISTS %s %s" % (table_name, column, type),
+                           skip=lambda db: db.has_column(table_name, column))
+
+class DropColumn(Statement):
+    """ Drop a column. Only marks it dropped, the space is reclaimed as rows get rewritten.
+        The backfill moving the data of the column, if given, runs once more right before, with the
+        table locked and in the same transaction, for the rows written since it ran (i.e. by processes
+        still running the previous version), so none of them is lost """
+
+    def __init__(self, table_name, column, backfill=None):
+        Statement.__init__(self, "ALTER TABLE %s DROP COLUMN IF EXISTS %s" % (table_name, column),
+                           skip=lambda db: not db.has_column(table_name, column))
+        self.table_name = table_name
+        self.backfill = backfill
+
+    def describe(self):
+        if self.backfill is None:
+            return self.sql
+        return "%s, after the rows left to %s" % (self.sql, self.backfill.description)
+
+    def execute(self, cur):
+        if self.backfill is not None:
+            cur.execute("LOCK TABLE %s IN ACCESS EXCLUSIVE MODE" % self.table_name)
+            print(".. %s: %d rows left" % (self.backfill.description, self.backfill.finish(cur)))
+        cur.execute(self.sql)
+
+class CreateTable(Step):
+    """ Create a missing table at its latest version, with its indexes """
+
+    def __init__(self, table_name):
+        Step.__init__(self, skip=lambda db: db.check_table(table_name))
+        self.table_name = table_name
+
+    def describe(self):
+        return "create table %s" % self.table_name
+
+    def run(self, db):
+        if not db.create_table(self.table_name):
+            raise psycopg2.ProgrammingError("Could not create table %s" % self.table_name)
+
+class CreateIndex(Step):
+    """ Build one of the indexes in DB.indexes without blocking writes to the table """
+
+    def __init__(self, table_name, name):
+        Step.__init__(self)
+        self.table_name = table_name
+        self.name = name
+
+    def sql(self, db):
+        definition = dict(db.indexes[self.table_name])[self.name]
+        return "CREATE INDEX CONCURRENTLY IF NOT EXISTS %s ON %s %s" % (self.name, self.table_name, definition)
+
+    def describe(self):
+        return "create index %s on %s (concurrently)" % (self.name, self.table_name)
+
+    def pending(self, db):
+        return db.index_valid(self.name) is not True
+
+    def run(self, db):
+        # CONCURRENTLY can't run in a transaction. A build that failed half way leaves an
+        #   invalid index behind, which has to be dropped before building it again. Checked
+        #   before taking the cursor, so the step holds a single connection
+        invalid = db.index_valid(self.name) is False
+        with db.cursor(autocommit=True) as cur:
+            if invalid:
+                print(".. Dropping invalid index: %s" % self.name)
+                cur.execute("DROP INDEX CONCURRENTLY IF EXISTS %s" % self.name)
+            cur.execute(self.sql(db))
+
+class Backfill(Step):
+    """ Change rows a batch per transaction, so row locks are held briefly.
+        batch(cur, last_key, size) handles up to size rows after last_key and
+        returns (rows handled, last key handled) """
+
+    def __init__(self, description, batch, skip=None, batch_size=None):
+        Step.__init__(self, skip)
+        self.description = description
+        self.batch = batch
+        self.batch_size = batch_size
+
+    def describe(self):
+        return "backfill: %s (%d rows per batch)" % (self.description, self.batch_size or BATCH_SIZE)
+
+    def run(self, db):
+        size = self.batch_size or BATCH_SIZE
+        last_key = ""
+        total = 0
+        while True:
+            with db.cursor() as cur:
+                count, last = self.batch(cur, last_key, size)
+            total += count
+            if count < size:
+                break
+            last_key = last
+            if BATCH_PAUSE:
+                time.sleep(BATCH_PAUSE)
+        print(".. %s: %d rows" % (self.description, total))
+
+    def finish(self, cur):
+        """ Handle the rows left, all in the transaction of cur. Returns how many there were """
+        size = self.batch_size or BATCH_SIZE
+        last_key = ""
+        total = 0
+        while True:
+            count, last_key = self.batch(cur, last_key, size)
+            total += count
+            if count < size:
+                return total
+
+def move_contents(cur, last_id, size):
+    # Move paste contents to the blobs table, indexed for search. content is text before version 2, bytea after
+    from db import SEARCH_CONFIG, SEARCH_MAX_CHARS
+    cur.execute("SELECT id, content FROM pastes WHERE id > %s AND content_hash IS NULL ORDER BY id LIMIT %s",
+                (last_id, size))
+    rows = cur.fetchall()
+    # Blobs from before version 2 of their table are indexed by its migration
+    cur.execute("SELECT 1 FROM information_schema.columns WHERE table_name = 'blobs' AND column_name = 'search'")
+    indexed = cur.fetchone() is not None
+    for id, content in rows:
+        if content is None:
+            text = ""
+        elif isinstance(content, str):
+            text = content
+        else:
+            text = compression.unpack(bytes(content))
+        hash = compression.content_hash(text)
+        cur.execute("INSERT INTO blobs (hash, content, refs) VALUES (%s, %s, 1) " +
+                    "ON CONFLICT (hash) DO UPDATE SET refs = blobs.refs + 1",
+                    (hash, compression.pack(text)))
+        if indexed:
+            cur.execute("UPDATE blobs SET search = to_tsvector(%s, %s) WHERE hash = %s AND search IS NULL",
+                        (SEARCH_CONFIG, text[:SEARCH_MAX_CHARS], hash))
+        cur.execute("UPDATE pastes SET content_hash = %s, content = NULL WHERE id = %s", (hash, id))
+    return len(rows), rows[-1][0] if rows else last_id
+
+def index_blobs(cur, last_hash, size):
+    # Fill the search column of the blobs
+    from db import SEARCH_CONFIG, SEARCH_MAX_CHARS
+    cur.execute("SELECT hash, content FROM blobs WHERE hash > %s AND search IS NULL ORDER BY hash LIMIT %s",
+                (last_hash, size))
+    rows = cur.fetchall()
+    for hash, content in rows:
+        text = compression.unpack(bytes(content))[:SEARCH_MAX_CHARS]
+        cur.execute("UPDATE blobs SET search = to_tsvector(%s, %s) WHERE hash = %s", (SEARCH_CONFIG, text, hash))
+    return len(rows), rows[-1][0] if rows else last_hash
+
+def fill_created_at(cur, last_id, size):
+    # Parse the created text of the pastes into created_at
+    cur.execute("SELECT id FROM pastes WHERE id > %s AND created_at IS NULL ORDER BY id LIMIT %s", (last_id, size))
+    ids = [row[0] for row in cur.fetchall()]
+    if ids:
+        cur.execute("UPDATE pastes SET created_at = CASE " +
+                    "WHEN created ~ '^[0-9]{2}/[0-9]{2}/[0-9]{2} at [0-9]{2}:[0-9]{2}:[0-9]{2}$' " +
+                    "THEN to_timestamp(created, 'MM/DD/YY \"at\" HH24:MI:SS') ELSE now() END " +
+                    "WHERE id = ANY(%s) AND created_at IS NULL", (ids, ))
+    return len(ids), ids[-1] if ids else last_id
+
+def split_blobs(cur, last_hash, size):
+    # Record the lines and size of the contents, moving the big ones to chunks
+    cur.execute("SELECT hash, content FROM blobs WHERE hash > %s AND lines IS NULL ORDER BY hash LIMIT %s",
+                (last_hash, size))
+    rows = cur.fetchall()
+    for hash, content in rows:
+        text = compression.unpack(bytes(content)) if content is not None else ""
+        lines, length = chunks.count_lines(text), len(text.encode('utf-8'))
+        if length > chunks.CHUNKED_MIN:
+            parts = chunks.split(text)
+            for number, (first, part) in enumerate(parts):
+                cur.execute("INSERT INTO chunks (hash, number, content) VALUES (%s, %s, %s) ON CONFLICT DO NOTHING",
+                            (hash, number, compression.pack(part)))
+            cur.execute("UPDATE blobs SET content = NULL, lines = %s, size = %s, line_index = %s WHERE hash = %s",
+                        (lines, length, [first for first, part in parts], hash))
+        else:
+            cur.execute("UPDATE blobs SET lines = %s, size = %s WHERE hash = %s", (lines, length, hash))
+    return len(rows), rows[-1][0] if rows else last_hash
+
+# Legacy contents have no size limit, keep their batches small
+move = Backfill("move contents to blobs", move_contents,
+                skip=lambda db: not db.has_column('pastes', 'content'), batch_size=20)
+
+# table -> {version: (description, steps)}
+MIGRATIONS = {
+    'pastes': {
+        # Compressed the content column in place. Version 3 moves the contents out of
+        #   pastes and reads both the text and the compressed form, so nothing is left to do
+        2: ("store contents compressed", []),
+        3: ("move contents to the blobs table, stored once per distinct content", [
+            CreateTable('blobs'),
+            AddColumn('pastes', 'content_hash', 'text'),
+            move,
+            Backfill("index blobs for search", index_blobs, batch_size=20),
+            Backfill("split big contents into chunks", split_blobs, batch_size=20),
+            # Moves the contents written meanwhile, in the transaction of the drop
+            DropColumn('pastes', 'content', backfill=move)]),
+        4: ("add created_at and the listing indexes", [
+            AddColumn('pastes', 'created_at', 'timestamptz'),
+            Backfill("fill created_at", fill_created_at),
+            CreateIndex('pastes', 'pastes_author'),
+            CreateIndex('pastes', 'pastes_language'),
+            CreateIndex('pastes', 'pastes_created'),
+            CreateIndex('pastes', 'pastes_temporary')]),
+        },
+    'blobs': {
+        2: ("add full text search of the contents", [
+            AddColumn('blobs', 'search', 'tsvector'),
+            Backfill("index blobs for search", index_blobs, batch_size=20),
+            CreateIndex('blobs', 'blobs_search')]),
+        3: ("store big contents in chunks, with a line index", [
+            CreateTable('chunks'),
+            AddColumn('blobs', 'lines', 'integer'),
+            AddColumn('blobs', 'size', 'integer'),
+            AddColumn('blobs', 'line_index', 'integer[]'),
+            # Contents are up to a few MB, keep the transactions small
+            Backfill("split big contents into chunks", split_blobs, batch_size=20)]),
+        },
+    }
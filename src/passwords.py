@@ -0,0 +1,95 @@
+#!/usr/bin/python3.4
+# Password hashing for protected pastes and the master password.
+#
+# Hashes are stored as "pbkdf2_sha256$<iterations>$<salt>$<hash>". Pastes
+# created before used a bare unsalted sha1 hex digest, those still verify and
+# are rehashed by the caller on the next successful login (see needs_update).
+#
+# To put a hash instead of the plain master password in pasteit.conf:
+#
+#     python src/passwords.py
+import binascii
+import hashlib
+import hmac
+import os
+import time
+from cache import LRUCache
+
+ALGORITHM = 'pbkdf2_sha256'
+
+# PBKDF2 rounds for new hashes, overridden by password_iterations in pasteit.conf
+ITERATIONS = 100000
+SALT_BYTES = 16
+
+# Successful checks are remembered this many seconds, so unlocking the same
+# paste again doesn't run the KDF again
+VERIFIED_TTL = 300
+VERIFIED_MAX = 10000
+
+verified = LRUCache(max_items=VERIFIED_MAX) # token -> time it was verified
+# Keys the verified tokens, so the cache never holds anything a password can be guessed from
+secret = os.urandom(32)
+
+def configure(config):
+    """ Read the work factor from the [pasteit] config section """
+    global ITERATIONS
+    ITERATIONS = int(config.get('password_iterations', ITERATIONS))
+
+def hash(password, iterations=None):
+    """ Hash a password with a fresh salt """
+    iterations = iterations or ITERATIONS
+    salt = binascii.hexlify(os.urandom(SALT_BYTES)).decode('ascii')
+    return "{0}${1}${2}${3}".format(ALGORITHM, iterations, salt, derive(password, salt, iterations))
+
+def derive(password, salt, iterations):
+    return binascii.hexlify(hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'),
+                                                salt.encode('ascii'), iterations)).decode('ascii')
+
+def is_legacy(encoded):
+    """ Check if a hash is an old unsalted sha1 one """
+    return len(encoded) == 40 and not encoded.startswith(ALGORITHM + '$')
+
+def needs_update(encoded):
+    """ Check if a hash should be replaced, after a successful verify() """
+    if is_legacy(encoded):
+        return True
+    try:
+        return int(encoded.split('$')[1]) < ITERATIONS
+    except (IndexError, ValueError):
+        return False
+
+def verify(password, encoded):
+    """ Check a password against a stored hash, in constant time """
+    if not password or not encoded:
+        return False
+    token = hmac.new(secret, (encoded + '\0' + password).encode('utf-8'), hashlib.sha256).digest()
+    when = verified.get(token)
+    if when is not None and time.time() - when < VERIFIED_TTL:
+        return True
+    if is_legacy(encoded):
+        valid = hmac.compare_digest(hashlib.sha1(password.encode('utf-8')).hexdigest().encode('ascii'),
+                                    encoded.encode('ascii'))
+    else:
+        try:
+            algorithm, iterations, salt, expected = encoded.split('$')
+            iterations = int(iterations)
+        except ValueError:
+            return False
+        if algorithm != ALGORITHM:
+            return False
+        valid = hmac.compare_digest(derive(password, salt, iterations).encode('ascii'), expected.encode('ascii'))
+    if valid:
+        verified.put(token, time.time())
+    return valid
+
+def verify_master(password, configured):
+    """ Check the master password, configured either hashed or (as it used to be) in plain text """
+    if not password or not configured:
+        return False
+    if configured.startswith(ALGORITHM + '$'):
+        return verify(password, configured)
+    return hmac.compare_digest(password.encode('utf-8'), configured.encode('utf-8'))
+
+if __name__ == "__main__":
+    import getpass
+    print(hash(getpass.getpass()))
@@ -17,70 +17,115 @@
 import os.path
 import os
 import cherrypy
-import hashlib
+import passwords
+import metrics
 import tools
 import repo
+import ratelimit
+import sessions # Registers the "postgres" sessions storage
 import json
 import time
+import datetime
 import requests
-from threading import Timer
-from cgi import escape
 
 pastes_repo = repo.PastesRepo()
 
+# The languages offered in the new paste form
+with open('languages.json', 'r') as f:
+    languages = json.load(f)
+
 class PasteIt:
     """ Root of PasteIt """
 
     # favicon_ico = None # Disable favicon
 
     @cherrypy.expose(['paste', 'view'])
-    @tools.template('see.html')
-    def default(self, id):
-        # Try to find the id
-        if 'password_inserted' not in cherrypy.session:
-            password = False
-        elif cherrypy.session['password_inserted'] == True:
-            password = True
-        else:
-            password = False
-            
-        try:
-            paste = pastes_repo.get(id)
-        except KeyError:
-            raise cherrypy.NotFound()
-        else:
+    def default(self, id, lines=None, page=None):
+        # Only a request with a session can be logged in, anonymous views don't start one.
+        #   The session is read anyway for pastes with a password
+        password = tools.has_session() and cherrypy.session.get('password_inserted') == True
+
+        # Public pages are served from memory once rendered. Only the default view of a paste
+        #   is kept, not every window of lines asked for
+        default_view = not lines and not page
+        cached = repo.pages.get('paste', id, password) if default_view else None
+        if cached is None:
+            # Taken before loading, so a page of a paste changed or deleted meanwhile isn't kept
+            since = repo.pages.version()
+            try:
+                paste = pastes_repo.get(id)
+            except KeyError:
+                raise cherrypy.NotFound()
             # If a password is set check if the password was already inserted
             if paste.password:
-                try:
-                    # If true show the paste
-                    if id in cherrypy.session['password_pastes']:
-                        return {'paste': paste, 'password': password, 'temporary': paste.temporary}
-                except KeyError:
-                    pass
-                # Else redirect to the password form
-                raise cherrypy.HTTPRedirect('/password?id='+id)
-            else:
-                return {'paste': paste, 'password': password, 'temporary': paste.temporary}
+                # If not redirect to the password form
+                if id not in cherrypy.session.get('password_pastes', []):
+                    raise cherrypy.HTTPRedirect('/password?id='+id)
+            # Big pastes are shown (and highlighted) a page of lines at a time
+            try:
+                window = paste.window(lines, page)
+            except ValueError:
+                raise cherrypy.NotFound()
+            if paste.password:
+                return self.see(paste, password, window)
+            # Pages showing the plain content while highlighting is in progress aren't kept
+            rendered = paste.isRendered(window)
+            body = self.see(paste, password, window).encode('utf-8')
+            if not rendered or not default_view:
+                return body
+            cached = repo.pages.put('paste', id, body, password, since=since)
+        metrics.note('page_size', len(cached.body))
+        return tools.serve_bytes(cached.body, 'text/html;charset=utf-8', cached.etag, gzipped=cached.gzipped)
+
+    @tools.template('see.html')
+    def see(self, paste, password, window=None):
+        return {'paste': paste, 'password': password, 'temporary': paste.temporary, 'window': window}
 
     @cherrypy.expose
     def raw(self, id):
-        try:
-            paste = pastes_repo.get(id)
-        except KeyError:
-            raise cherrypy.NotFound()
-        else:
+        # Public pastes are served from memory
+        page = repo.pages.get('raw', id)
+        if page is None:
+            since = repo.pages.version()
+            try:
+                paste = pastes_repo.get(id)
+            except KeyError:
+                raise cherrypy.NotFound()
             # If a password is set check if the password was already inserted
             if paste.password:
-                try:
-                    # If true show the paste
-                    if id in cherrypy.session['password_pastes']:
-                        return "<pre>" + paste.content + "</pre>"
-                except KeyError:
-                    pass
-                # Else redirect to the password form
-                raise cherrypy.HTTPRedirect('/password/?id='+id+'&next=/raw/'+id)
-            else:
-                return "<pre>" + escape(paste.content) + "</pre>"
+                # If not redirect to the password form
+                if id not in cherrypy.session.get('password_pastes', []):
+                    raise cherrypy.HTTPRedirect('/password/?id='+id+'&next=/raw/'+id)
+            if paste.isChunked():
+                # Big contents are streamed a few chunks at a time, and not kept in the page cache
+                metrics.note('paste_size', paste.size())
+                return tools.serve_chunks(paste.stream(), paste.size(), 'text/plain;charset=utf-8', paste.contentHash(),
+                                          paste.createdAt(formatted=False),
+                                          "private, no-cache" if paste.password else "public, max-age=300")
+            if paste.password:
+                body = paste.content.encode('utf-8')
+                metrics.note('paste_size', len(body))
+                return tools.serve_bytes(body, 'text/plain;charset=utf-8', paste.contentHash(),
+                                         paste.createdAt(formatted=False), "private, no-cache", paste.gzipped())
+            # Compressed contents are sent as stored, instead of being compressed again
+            page = repo.pages.put('raw', id, paste.content.encode('utf-8'),
+                                  etag=paste.contentHash(), modified=paste.createdAt(formatted=False),
+                                  gzipped=paste.gzipped(), since=since)
+        metrics.note('paste_size', len(page.body))
+        return tools.serve_bytes(page.body, 'text/plain;charset=utf-8', page.etag, page.modified,
+                                 "public, max-age=300", page.gzipped)
+    raw._cp_config = {'response.stream': True}
+
+    @cherrypy.expose
+    def metrics(self):
+        """ Counters and timings in the Prometheus text format """
+        # Only admins can read them, unless they're public
+        if not metrics.PUBLIC and cherrypy.session.get('password_inserted') != True:
+            raise cherrypy.HTTPError(403)
+        cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+        return metrics.exposition()
+    # Scrapes aren't requests worth timing
+    metrics._cp_config = {'tools.metrics.on': False, 'tools.ratelimit.on': False}
 
     @cherrypy.expose('new')
     @tools.template('index.html')
@@ -91,9 +136,7 @@ class PasteIt:
         else:
             result = {}
             result['error'] = None
-            # Obtain the languages list
-            with open('languages.json', 'r') as f:
-                result['languages'] = json.load(f)
+            result['languages'] = languages
             # If the method is POST, suppose that the user want to save the paste
             if cherrypy.request.method == 'POST':
                 # Author and content are required!
@@ -109,11 +152,15 @@ class PasteIt:
                     else:
                         temporary = False
                     # Try to create the paste
-                    # If it was created, go to it
+                    # If it was created, go to it. Big contents come as a part spooled to a temporary file
                     try:
-                        id = pastes_repo.create(content, password, author, language, temporary)
+                        id = pastes_repo.create(getattr(content, 'file', content), password, author, language, temporary)
                     except ValueError as e:
                         result['error'] = str(e)
+                    except repo.Busy:
+                        cherrypy.response.status = 503
+                        cherrypy.response.headers['Retry-After'] = str(max(int(repo.CREATE_WAIT_SECONDS), 1))
+                        result['error'] = 'Too many pastes are being created, try again in a moment'
                     else:
                         # If a password was set, automatically allow you to see the paste
                         if password:
@@ -124,7 +171,28 @@ class PasteIt:
                             cherrypy.session['password_pastes'].append(id)
                         raise cherrypy.HTTPRedirect('/'+id)
             return result
+    # Big contents are read from a temporary file, not kept in memory as a form field
+    index._cp_config = {'request.body.part_class': tools.SpooledPart}
                 
+    @cherrypy.expose('list')
+    @tools.template('list.html')
+    def listing(self, author=None, language=None, since=None, until=None, q=None, after=None):
+        # Only admins can browse the pastes
+        if cherrypy.session.get('password_inserted') != True:
+            raise cherrypy.HTTPRedirect('/password?next=/list')
+        result = {'error': None, 'pastes': [], 'next': None, 'languages': languages,
+            'query': {'author': author or '', 'language': language or '', 'since': since or '',
+                      'until': until or '', 'q': q or ''}}
+        # Dates are YYYY-MM-DD, until is inclusive
+        try:
+            since = datetime.datetime.strptime(since, "%Y-%m-%d") if since else None
+            until = datetime.datetime.strptime(until, "%Y-%m-%d") + datetime.timedelta(days=1) if until else None
+        except ValueError:
+            result['error'] = 'Invalid date, use YYYY-MM-DD'
+            return result
+        result['pastes'], result['next'] = pastes_repo.search(author, language, since, until, q, after)
+        return result
+
     @cherrypy.expose
     def change(self, id):
         if 'password_inserted' not in cherrypy.session:
@@ -145,18 +213,12 @@ class PasteIt:
                 if paste.temporary == True:
                     paste.temporary = False
                     self.created = time.strftime("%m/%d/%y at %H:%M:%S")
-                    try:
-                        paste.timer.cancel()
-                        paste.timer = None
-                    except Exception as e:
-                        print("Something went wrong while canceling a timer, but it's alright:")
-                        print(e)
+                    pastes_repo.expiry.cancel(paste.id)
                 else:
                     paste.temporary = True
                     paste.created = time.strftime("%m/%d/%y at %H:%M:%S")
-                    paste.timer = Timer(10800, lambda p: p.delete(), [paste])
-                    paste.timer.start()
-                    print("Set a timer for paste '{0}'.".format(paste.id))
+                    pastes_repo.expiry.schedule(paste.id, paste.expiresAt())
+                    print("Scheduled expiry of paste '{0}'.".format(paste.id))
                 paste.save()
                 raise cherrypy.HTTPRedirect('/'+id)
 
@@ -177,7 +239,7 @@ class PasteIt:
             if not password:
                 raise cherrypy.HTTPRedirect('/password')
             else: #logged in
-                paste.delete(pastes_repo) # whoosh, gone
+                paste.delete() # whoosh, gone
                 raise cherrypy.HTTPRedirect('/')
                 
     @cherrypy.expose('login')
@@ -204,14 +266,17 @@ class PasteIt:
                 else:
                     # If a password is set, the valid one is that, else raise a not found
                     if paste.password:
-                        valid = paste.password
-                        password = hashlib.sha1(password.encode('utf-8')).hexdigest() # sha1-ize the password
+                        valid = passwords.verify(password, paste.password)
+                        # Old sha1 hashes (or ones with fewer rounds) are replaced once we know the password
+                        if valid and passwords.needs_update(paste.password):
+                            paste.password = passwords.hash(password)
+                            paste.save()
                     else:
                         raise cherrypy.NotFound()
             # Else check for the global one
             else:
-                valid = cherrypy.tree.apps[''].config['pasteit']['password']
-            if password == valid:
+                valid = passwords.verify_master(password, cherrypy.tree.apps[''].config['pasteit']['password'])
+            if valid:
                 # If an id was provided, redirect to the correct paste
                 if id: #NOTE:........ does this ever happen?
                     # Boot the password_pastes key
@@ -239,11 +304,29 @@ class PasteIt:
             result['next'] = next
         return result
 
-if __name__ == "__main__":
-    cherrypy.tree.mount( PasteIt(), '', 'pasteit.conf' ) # Mount the PasteIt object
+def mount():
+    """ Mount the PasteIt application and tie the background workers to the engine """
+    app = cherrypy.tree.mount( PasteIt(), '', 'pasteit.conf' ) # Mount the PasteIt object
 
     # Update jinja2 env with the configuration
-    tools.jinja_env.globals['config'] = cherrypy.tree.apps[''].config['pasteit']
+    tools.jinja_env.globals['config'] = app.config['pasteit']
+    passwords.configure(app.config['pasteit'])
+    metrics.configure(app.config['pasteit'])
+    tools.configure(app.config['pasteit'])
+    repo.configure(app.config['pasteit'])
+    ratelimit.configure(app.config['pasteit'], repo.db)
+    # Public scrapes don't need a session
+    if metrics.PUBLIC:
+        app.merge({'/metrics': {'tools.sessions.on': False}})
+
+    # Stop the expiry thread and close the pooled db connections on shutdown
+    cherrypy.engine.subscribe('stop', pastes_repo.expiry.stop)
+    cherrypy.engine.subscribe('stop', repo.renderer.shutdown)
+    cherrypy.engine.subscribe('stop', repo.db.close)
+    return app
+
+if __name__ == "__main__":
+    mount()
     
     cherrypy.config.update({'server.socket_host': '0.0.0.0',
                          'server.socket_port': int(os.environ.get('PORT', 5000)),
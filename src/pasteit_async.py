@@ -0,0 +1,476 @@
+#!/usr/bin/python3.5
+# Asyncio serving mode: the same routes as pasteit.py, served by aiohttp from a
+# single event loop, so slow clients don't hold a worker thread each.
+# Needs Python >= 3.5 and aiohttp. Run it from the repository root:
+#
+#     python src/pasteit_async.py
+#
+# Database work runs through adb.AsyncDB, templates are rendered off the loop
+# and big pastes are highlighted in the render process pool (see render.py).
+# Sessions use the same sessions table as the "postgres" cherrypy storage,
+# so both modes can serve the same db side by side.
+import asyncio
+import binascii
+import datetime
+import email.utils
+import json
+import os
+import pickle
+import tempfile
+import time
+import cherrypy.lib.reprconf
+import psycopg2
+from aiohttp import web
+import metrics
+import passwords
+import ratelimit
+import repo
+import tools
+from adb import AsyncDB
+
+# Name and lifetime of the session cookie, as cherrypy's defaults
+SESSION_COOKIE = 'session_id'
+SESSION_TIMEOUT = datetime.timedelta(minutes=60)
+# How often expired sessions are deleted, as cherrypy's clean_freq
+SESSION_CLEANUP = datetime.timedelta(minutes=5)
+
+config = cherrypy.lib.reprconf.Parser().dict_from_file('pasteit.conf')['pasteit']
+tools.jinja_env.globals['config'] = config
+passwords.configure(config)
+metrics.configure(config)
+tools.configure(config)
+repo.configure(config)
+
+with open('languages.json', 'r') as f:
+    languages = json.load(f)
+
+pastes_repo = repo.PastesRepo()
+adb = AsyncDB(repo.db)
+ratelimit.configure(config, repo.db)
+
+# The handlers of pasteit.py, whose names are the routes of rate_limits
+ROUTES = {'index': 'index', 'view': 'default', 'raw': 'raw', 'password': 'password', 'listing': 'listing',
+          'change': 'change', 'delete': 'delete'}
+
+@web.middleware
+async def timing(request, handler):
+    """ Count and time requests. Stage breakdowns are per thread, so they're not kept for single requests here """
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.count('requests_total', status=str(status))
+        metrics.observe('request', elapsed)
+        if metrics.SLOW_REQUEST_SECONDS is not None and elapsed >= metrics.SLOW_REQUEST_SECONDS:
+            print("!! Slow request: {0} {1} {2:.1f} ms".format(request.method, request.path, elapsed * 1000))
+
+@web.middleware
+async def rate_limits(request, handler):
+    """ Answer 429 to clients over the rate limit of the route, like tools.ratelimit """
+    route = ROUTES.get(getattr(request.match_info.handler, '__name__', None))
+    if route is None: # Static files and metrics scrapes
+        return await handler(request)
+    client = request.remote or ''
+    if isinstance(ratelimit.store, ratelimit.MemoryBuckets):
+        wait = ratelimit.check(client, route)
+    else:
+        wait = await adb.run(ratelimit.check, client, route)
+    if wait:
+        return web.Response(status=429, text='Too many requests, try again later.',
+                            headers={'Retry-After': str(int(wait) + 1)})
+    return await handler(request)
+
+@web.middleware
+async def sessions(request, handler):
+    """ Load the session before the handler and save it after, like tools.sessions. Sessions are
+    only stored once something is put in them, anonymous requests don't leave a row behind """
+    # Static files and public metrics scrapes don't need one
+    if (request.path == '/metrics' and metrics.PUBLIC) or request.path.startswith('/assets/'):
+        return await handler(request)
+    id = request.cookies.get(SESSION_COOKIE)
+    data = None
+    expiration_time = None
+    if id:
+        rows = await adb.get_data('sessions', 'id', id, columns=('data', 'expiration_time'))
+        if rows and rows[0][1] > datetime.datetime.now():
+            try:
+                data = pickle.loads(bytes(rows[0][0]))
+                expiration_time = rows[0][1]
+            except Exception:
+                data = None
+    if data is None:
+        id = binascii.hexlify(os.urandom(20)).decode('ascii')
+        data = {}
+    request['session_id'] = id
+    request['session'] = data
+    request['session_loaded'] = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+    request['session_stored'] = expiration_time is not None
+    response = None
+    try:
+        response = await handler(request)
+        return response
+    except web.HTTPException as e:
+        response = e
+        raise
+    finally:
+        pickled = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        # Sessions in use are saved again once half their lifetime is gone, so they don't expire
+        refresh = expiration_time is not None and expiration_time - datetime.datetime.now() < SESSION_TIMEOUT / 2
+        if pickled != request['session_loaded'] or refresh:
+            await adb.upsert_data('sessions', {'id': id, 'data': psycopg2.Binary(pickled),
+                'expiration_time': datetime.datetime.now() + SESSION_TIMEOUT})
+            request['session_stored'] = True
+        if response is not None:
+            session_cookie(request, response)
+
+def session_cookie(request, response):
+    """ Set the cookie of a session that is (or is about to be) stored, unless the response already
+    started (send() sets it earlier) or shared caches may keep it, see tools.no_shared_cookie """
+    stored = request['session_stored'] or pickle.dumps(request['session'], pickle.HIGHEST_PROTOCOL) != request['session_loaded']
+    if stored and not response.prepared and not response.headers.get('Cache-Control', '').startswith('public'):
+        response.set_cookie(SESSION_COOKIE, request['session_id'], path='/')
+
+async def clean_sessions():
+    """ Delete the expired sessions every SESSION_CLEANUP, cherrypy's clean_up monitor doesn't run here """
+    while True:
+        await adb.delete_older_than('sessions', 'expiration_time', datetime.datetime.now())
+        await asyncio.sleep(SESSION_CLEANUP.total_seconds())
+
+async def startup(app):
+    """ Start the background tasks """
+    app['session_cleanup'] = asyncio.ensure_future(clean_sessions())
+
+async def template(name, result):
+    """ Render a template off the event loop """
+    body = await adb.run(lambda: tools.get_template(name).render(**result))
+    return web.Response(text=body, content_type='text/html')
+
+async def lookup(id):
+    """ Get a paste or answer 404 """
+    try:
+        return await adb.run(pastes_repo.get, id)
+    except KeyError:
+        raise web.HTTPNotFound()
+
+def is_admin(session):
+    return session.get('password_inserted') == True
+
+async def send(request, data, content_type, etag, modified=None, cache_control="no-cache", gzipped=None):
+    """ Stream a body with validators, like tools.serve_bytes """
+    headers = {'Cache-Control': cache_control, 'Accept-Ranges': 'bytes'}
+    range_header = request.headers.get('Range')
+    if gzipped is not None:
+        headers['Vary'] = 'Accept-Encoding'
+        if not range_header and 'gzip' in request.headers.get('Accept-Encoding', ''):
+            data = gzipped
+            etag = etag + '-gz'
+            headers['Content-Encoding'] = 'gzip'
+    etag = '"' + etag + '"'
+    headers['ETag'] = etag
+    if modified:
+        headers['Last-Modified'] = email.utils.formatdate(modified, usegmt=True)
+    # The client already has it
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match and (if_none_match.strip() == '*' or etag in [t.strip() for t in if_none_match.split(',')]):
+        headers.pop('Content-Encoding', None)
+        return web.Response(status=304, headers=headers)
+    status = 200
+    start, stop = 0, len(data)
+    if range_header and request.headers.get('If-Range', etag) == etag:
+        try:
+            start, stop, step = request.http_range.indices(len(data))
+        except ValueError:
+            start, stop = 0, len(data)
+        else:
+            if start >= len(data) or start >= stop:
+                headers['Content-Range'] = 'bytes */%d' % len(data)
+                raise web.HTTPRequestRangeNotSatisfiable(headers=headers)
+            status = 206
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, len(data))
+    headers['Content-Type'] = content_type
+    response = web.StreamResponse(status=status, headers=headers)
+    response.content_length = stop - start
+    session_cookie(request, response)
+    await response.prepare(request)
+    for chunk in tools.stream(data, start, stop):
+        await response.write(chunk)
+    await response.write_eof()
+    return response
+
+async def send_chunks(request, paste, cache_control):
+    """ Stream a chunked paste content, like tools.serve_chunks """
+    etag = '"' + paste.contentHash() + '"'
+    headers = {'Cache-Control': cache_control, 'Accept-Ranges': 'none', 'ETag': etag,
+               'Last-Modified': email.utils.formatdate(paste.createdAt(formatted=False), usegmt=True)}
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match and (if_none_match.strip() == '*' or etag in [t.strip() for t in if_none_match.split(',')]):
+        return web.Response(status=304, headers=headers)
+    headers['Content-Type'] = 'text/plain; charset=utf-8'
+    response = web.StreamResponse(headers=headers)
+    response.content_length = paste.size()
+    session_cookie(request, response)
+    await response.prepare(request)
+    chunks = paste.stream()
+    while True:
+        # Each chunk is read from the db off the event loop
+        chunk = await adb.run(next, chunks, None)
+        if chunk is None:
+            break
+        await response.write(chunk)
+    await response.write_eof()
+    return response
+
+async def index(request):
+    session = request['session']
+    # If they haven't inserted the password redirect 'em to the login form
+    if config['password'] and 'password_inserted' not in session:
+        raise web.HTTPFound('/password')
+    result = {'error': None, 'languages': languages}
+    # If the method is POST, suppose that the user want to save the paste
+    if request.method == 'POST':
+        form = await read_form(request)
+        author = form.get('author')
+        content = form.get('content')
+        # Author and content are required!
+        if not author or not content:
+            result['error'] = 'Something is missing'
+        else:
+            # If the password wasn't provided, suppose the user doesn't want it
+            password = form.get('password') or False
+            temporary = bool(form.get('temporary'))
+            try:
+                id = await adb.run(pastes_repo.create, content, password, author, form.get('language', 'text'), temporary)
+            except ValueError as e:
+                result['error'] = str(e)
+            except repo.Busy:
+                result['error'] = 'Too many pastes are being created, try again in a moment'
+                response = await template('index.html', result)
+                response.set_status(503)
+                response.headers['Retry-After'] = str(max(int(repo.CREATE_WAIT_SECONDS), 1))
+                return response
+            else:
+                # If a password was set, automatically allow you to see the paste
+                if password:
+                    session.setdefault('password_pastes', []).append(id)
+                raise web.HTTPFound('/'+id)
+    return await template('index.html', result)
+
+async def read_form(request):
+    """ Read the new paste form. A multipart content is spooled to a temporary file instead of kept in memory """
+    if request.content_length and request.content_length > tools.MAX_REQUEST_BYTES:
+        raise web.HTTPRequestEntityTooLarge(max_size=tools.MAX_REQUEST_BYTES, actual_size=request.content_length)
+    if not request.content_type.startswith('multipart/'):
+        return await request.post()
+    form = {}
+    size = 0
+    reader = await request.multipart()
+    while True:
+        part = await reader.next()
+        if part is None:
+            break
+        if part.name == 'content':
+            spool = tempfile.SpooledTemporaryFile(max_size=tools.SPOOL_MIN)
+            while True:
+                chunk = await part.read_chunk()
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > tools.MAX_REQUEST_BYTES:
+                    spool.close()
+                    raise web.HTTPRequestEntityTooLarge(max_size=tools.MAX_REQUEST_BYTES, actual_size=size)
+                spool.write(chunk)
+            form['content'] = spool if spool.tell() else ""
+        else:
+            form[part.name] = await part.text()
+            size += len(form[part.name])
+            # Only the content can be big, as in tools.SpooledPart
+            if len(form[part.name]) > tools.SPOOL_MIN:
+                raise web.HTTPRequestEntityTooLarge(max_size=tools.SPOOL_MIN, actual_size=len(form[part.name]))
+    return form
+
+async def view(request):
+    session = request['session']
+    id = request.match_info['id']
+    password = is_admin(session)
+    lines, page_number = request.query.get('lines'), request.query.get('page')
+    # Public pages are served from memory once rendered. Only the default view of a paste
+    #   is kept, not every window of lines asked for
+    default_view = not lines and not page_number
+    page = repo.pages.get('paste', id, password) if default_view else None
+    if page is None:
+        # Taken before loading, so a page of a paste changed or deleted meanwhile isn't kept
+        since = repo.pages.version()
+        paste = await lookup(id)
+        # If a password is set check if the password was already inserted
+        if paste.password:
+            if id not in session.get('password_pastes', []):
+                raise web.HTTPFound('/password?id='+id)
+        # Big pastes are shown (and highlighted) a page of lines at a time
+        try:
+            window = await adb.run(paste.window, lines, page_number)
+        except ValueError:
+            raise web.HTTPNotFound()
+        result = {'paste': paste, 'password': password, 'temporary': paste.temporary, 'window': window}
+        if paste.password:
+            return await template('see.html', result)
+        # Pages showing the plain content while highlighting is in progress aren't kept
+        rendered = await adb.run(paste.isRendered, window) # may fetch the content
+        response = await template('see.html', result)
+        if not rendered or not default_view:
+            return response
+        page = repo.pages.put('paste', id, response.body, password, since=since)
+    return await send(request, page.body, 'text/html; charset=utf-8', page.etag, gzipped=page.gzipped)
+
+async def raw(request):
+    session = request['session']
+    id = request.match_info['id']
+    # Public pastes are served from memory
+    page = repo.pages.get('raw', id)
+    if page is None:
+        since = repo.pages.version()
+        paste = await lookup(id)
+        # If a password is set check if the password was already inserted
+        if paste.password:
+            if id not in session.get('password_pastes', []):
+                raise web.HTTPFound('/password/?id='+id+'&next=/raw/'+id)
+        # Fetch the content off the event loop, the paste only comes with its metadata
+        await adb.run(paste.stored)
+        if await adb.run(paste.isChunked):
+            # Big contents are streamed a few chunks at a time, and not kept in the page cache
+            return await send_chunks(request, paste, "private, no-cache" if paste.password else "public, max-age=300")
+        if paste.password:
+            return await send(request, paste.content.encode('utf-8'), 'text/plain; charset=utf-8', paste.contentHash(),
+                              paste.createdAt(formatted=False), "private, no-cache", paste.gzipped())
+        # Compressed contents are sent as stored, instead of being compressed again
+        page = repo.pages.put('raw', id, paste.content.encode('utf-8'),
+                              etag=paste.contentHash(), modified=paste.createdAt(formatted=False),
+                              gzipped=paste.gzipped(), since=since)
+    return await send(request, page.body, 'text/plain; charset=utf-8', page.etag, page.modified,
+                      "public, max-age=300", page.gzipped)
+
+async def listing(request):
+    # Only admins can browse the pastes
+    if not is_admin(request['session']):
+        raise web.HTTPFound('/password?next=/list')
+    params = request.query
+    query = dict((key, params.get(key, '')) for key in ('author', 'language', 'since', 'until', 'q'))
+    result = {'error': None, 'pastes': [], 'next': None, 'languages': languages, 'query': query}
+    # Dates are YYYY-MM-DD, until is inclusive
+    try:
+        since = datetime.datetime.strptime(query['since'], "%Y-%m-%d") if query['since'] else None
+        until = datetime.datetime.strptime(query['until'], "%Y-%m-%d") + datetime.timedelta(days=1) if query['until'] else None
+    except ValueError:
+        result['error'] = 'Invalid date, use YYYY-MM-DD'
+        return await template('list.html', result)
+    result['pastes'], result['next'] = await adb.run(pastes_repo.search, query['author'], query['language'],
+                                                     since, until, query['q'], params.get('after'))
+    return await template('list.html', result)
+
+async def change(request):
+    paste = await lookup(request.match_info['id'])
+    if not is_admin(request['session']):
+        raise web.HTTPFound('/password')
+    if paste.temporary == True:
+        paste.temporary = False
+        pastes_repo.expiry.cancel(paste.id)
+    else:
+        paste.temporary = True
+        paste.created = time.strftime("%m/%d/%y at %H:%M:%S")
+        pastes_repo.expiry.schedule(paste.id, paste.expiresAt())
+    await adb.run(paste.save)
+    raise web.HTTPFound('/'+paste.id)
+
+async def delete(request):
+    paste = await lookup(request.match_info['id'])
+    if not is_admin(request['session']):
+        raise web.HTTPFound('/password')
+    await adb.run(paste.delete) # whoosh, gone
+    raise web.HTTPFound('/')
+
+async def password(request):
+    session = request['session']
+    params = dict(request.query)
+    if request.method == 'POST':
+        params.update(await request.post())
+    id = params.get('id')
+    password = params.get('password')
+    next = params.get('next')
+    result = {'error': None, 'paste_id': None, 'next': None}
+    if not id and is_admin(session):
+        raise web.HTTPFound(next or '/')
+    # If the password was provided, check if it's correct
+    if password != None:
+        # If an ID is provided, then the password is the one of that ID
+        if id:
+            paste = await lookup(id)
+            # If a password is set, the valid one is that, else raise a not found
+            if not paste.password:
+                raise web.HTTPNotFound()
+            # The KDF is slow on purpose, run it off the event loop
+            valid = await adb.run(passwords.verify, password, paste.password)
+            # Old sha1 hashes (or ones with fewer rounds) are replaced once we know the password
+            if valid and passwords.needs_update(paste.password):
+                paste.password = await adb.run(passwords.hash, password)
+                await adb.run(paste.save)
+        # Else check for the global one
+        else:
+            valid = await adb.run(passwords.verify_master, password, config['password'])
+        if valid:
+            if id:
+                session.setdefault('password_pastes', []).append(id)
+                raise web.HTTPFound(next or '/'+id)
+            else:
+                session['password_inserted'] = True
+                raise web.HTTPFound(next or '/')
+        else:
+            result['error'] = 'Invalid password!'
+    # Set up some defaults
+    if id:
+        result['paste_id'] = id
+    if next:
+        result['next'] = next
+    return await template('password.html', result)
+
+async def metrics_page(request):
+    """ Counters and timings in the Prometheus text format """
+    # Only admins can read them, unless they're public
+    if not metrics.PUBLIC and not is_admin(request['session']):
+        raise web.HTTPForbidden()
+    return web.Response(text=metrics.exposition(), content_type='text/plain', charset='utf-8')
+
+async def cleanup(app):
+    """ Stop the background workers and close the db connections """
+    app['session_cleanup'].cancel()
+    pastes_repo.expiry.stop()
+    repo.renderer.shutdown()
+    adb.close()
+    repo.db.close()
+
+def application():
+    """ Build the aiohttp application """
+    app = web.Application(middlewares=[timing, rate_limits, sessions], client_max_size=tools.MAX_REQUEST_BYTES)
+    app.router.add_static('/assets', 'assets')
+    for path in ('/', '/new', '/index'):
+        app.router.add_route('*', path, index)
+    for path in ('/password', '/password/', '/login'):
+        app.router.add_route('*', path, password)
+    app.router.add_get('/metrics', metrics_page)
+    app.router.add_get('/list', listing)
+    app.router.add_get('/raw/{id}', raw)
+    app.router.add_get('/change/{id}', change)
+    app.router.add_get('/delete/{id}', delete)
+    for path in ('/{id}', '/paste/{id}', '/view/{id}'):
+        app.router.add_get(path, view)
+    app.on_startup.append(startup)
+    app.on_cleanup.append(cleanup)
+    return app
+
+if __name__ == "__main__":
+    web.run_app(application(), host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
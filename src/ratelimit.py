@@ -0,0 +1,112 @@
+#!/usr/bin/python3.4
+# Per-client rate limiting with token buckets.
+#
+# Every (client ip, route) pair has a bucket of up to `burst` tokens, refilled
+# at `rate` tokens per second. A request takes a token, or is answered with a
+# 429 and a Retry-After telling when the next one will be there. Routes are
+# named after their handler (index, default, raw, password, ...) and their
+# limits are set with rate_limits in pasteit.conf, "*" for the routes not listed.
+#
+# The buckets are kept by a store, with a single take() method:
+#
+#   MemoryBuckets    in this process (the default), idle buckets are forgotten
+#   PostgresBuckets  in the rate_limits table, shared by every worker process
+import collections
+import datetime
+import threading
+import time
+import metrics
+
+# Requests per second and burst allowed per client, by route
+RATE_LIMITS = {'*': (20.0, 200)}
+# Seconds after which an unused bucket is forgotten, it would be full again anyway
+IDLE_SECONDS = 600
+# Most buckets kept in memory, the least recently used go first
+MAX_BUCKETS = 100000
+
+class MemoryBuckets:
+    """ Token buckets in the memory of this process """
+
+    def __init__(self, idle=IDLE_SECONDS, max_buckets=MAX_BUCKETS):
+        self.idle = idle
+        self.max_buckets = max_buckets
+        self.buckets = collections.OrderedDict() # key -> (tokens, last update), least recently used first
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """ Take a token from a bucket, returns 0 or the seconds until a token is available """
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.pop(key, None)
+            if bucket is None:
+                tokens = float(burst)
+            else:
+                tokens = min(float(burst), bucket[0] + (now - bucket[1]) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / rate
+            self.buckets[key] = (tokens, now)
+            self.__evict(now)
+        return wait
+
+    def __evict(self, now):
+        # The oldest buckets are checked first, so each request only looks at the ones it evicts
+        while self.buckets:
+            key, (tokens, updated) = next(iter(self.buckets.items()))
+            if now - updated < self.idle and len(self.buckets) <= self.max_buckets:
+                break
+            self.buckets.popitem(last=False)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.buckets)
+
+class PostgresBuckets:
+    """ Token buckets in the db, shared by every process serving it. Fails open on db errors """
+
+    def __init__(self, db, idle=IDLE_SECONDS):
+        self.db = db
+        self.idle = idle
+        self.evicted = time.monotonic()
+
+    def take(self, key, rate, burst):
+        """ Take a token from a bucket, returns 0 or the seconds until a token is available """
+        wait = self.db.take_token('rate_limits', key, rate, burst)
+        now = time.monotonic()
+        if now - self.evicted > self.idle:
+            self.evicted = now
+            cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=self.idle)
+            self.db.delete_older_than('rate_limits', 'updated', cutoff)
+        return wait or 0
+
+    def __len__(self):
+        return self.db.count_data('rate_limits') or 0
+
+store = MemoryBuckets()
+
+metrics.register(lambda: [('rate_limit_buckets', {}, len(store))])
+
+def configure(config, db=None):
+    """ Read the limits and the store from the [pasteit] config section """
+    global RATE_LIMITS, IDLE_SECONDS, store
+    RATE_LIMITS = dict(config.get('rate_limits', RATE_LIMITS))
+    # Long enough for the slowest bucket to fill up again
+    IDLE_SECONDS = max([IDLE_SECONDS] + [burst / rate for rate, burst in RATE_LIMITS.values()])
+    if config.get('rate_limit_store', 'memory') == 'postgres':
+        store = PostgresBuckets(db, IDLE_SECONDS)
+    else:
+        store = MemoryBuckets(IDLE_SECONDS)
+
+def check(client, route):
+    """ Take a token for a request of a client to a route. Returns 0, or the seconds
+    the client has to wait when it's over its limit """
+    limit = RATE_LIMITS.get(route) or RATE_LIMITS.get('*')
+    if not limit:
+        return 0
+    rate, burst = limit
+    wait = store.take(client + ' ' + route, rate, burst)
+    if wait:
+        metrics.count('rate_limited_total', route=route)
+    return wait
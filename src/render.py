@@ -0,0 +1,185 @@
+#!/usr/bin/python3.4
+import concurrent.futures
+import glob
+import hashlib
+import html
+import os
+import os.path
+import re
+import tempfile
+import threading
+import pygments.lexers
+import chunks
+import detect
+import tools
+from cache import LRUCache
+
+# Options passed to pygments' HtmlFormatter, part of the cache key
+FORMATTER_OPTIONS = {}
+
+# Bounds of the in-memory render cache
+RENDER_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# Where rendered pastes are persisted between restarts (None to keep them in memory only)
+RENDER_CACHE_DIR = os.path.join(os.path.dirname(__file__), "..", "pastes")
+
+# Processes highlighting pastes in the background (None for one per core)
+RENDER_WORKERS = None
+
+# Pastes up to this many characters are cheaper to highlight right away than to hand off
+INLINE_RENDER_MAX = 4096
+
+def render(content, language):
+    """ Highlight a paste content, runs in the worker processes """
+    # Detect which lexer use
+    if language == "guess":
+        language = detect.detect(content)
+    # Leading and trailing blank lines are kept, so a window renders exactly its lines (see cut())
+    lexer = pygments.lexers.get_lexer_by_name(language, stripnl=False)
+    return tools.highlight(content, lexer, **FORMATTER_OPTIONS)
+
+def cut(renderings, start_line, first, last):
+    """ Cut lines first to last (inclusive) out of the renderings of consecutive windows of lines,
+    the first one starting at line start_line, keeping the markup around the lines of the first one.
+    Pygments closes its tags at every line end, so the lines of its output stand on their own """
+    lines = []
+    for rendering in renderings:
+        start = re.search(r"<pre[^>]*>", rendering).end()
+        lines.append(rendering[start:rendering.rindex('</pre>')])
+    head = renderings[0][:re.search(r"<pre[^>]*>", renderings[0]).end()]
+    tail = renderings[0][renderings[0].rindex('</pre>'):]
+    return head + chunks.select_lines("".join(lines), start_line, first, last) + tail
+
+def fallback(content):
+    """ Plain escaped content, shown while the highlighted version is being rendered """
+    return html.escape(content)
+
+class RenderCache:
+    """ Memoizes the highlighted HTML of pastes
+
+    Entries are keyed by the content hash, language and formatter options
+    they were rendered with, so pastes with the same content share them.
+    Big pastes are rendered a page of lines at a time, each cached apart
+    (see Paste.renderWindows), other windows are cut out of those.
+    """
+
+    def __init__(self, max_bytes=RENDER_CACHE_MAX_BYTES, directory=RENDER_CACHE_DIR):
+        self.memory = LRUCache(max_bytes=max_bytes)
+        self.directory = directory
+
+    def digest(self, paste, window=None):
+        """ Return the digest of everything the rendered output depends on """
+        options = repr(sorted(FORMATTER_OPTIONS.items()))
+        key = "{0}\n{1}\n{2}".format(paste.contentHash(), paste.language, options)
+        if window is not None:
+            key += "\n{0}-{1}".format(*window)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get(self, paste, window=None):
+        """ Return the cached rendering of a paste (or of a window of its lines), or None """
+        digest = self.digest(paste, window)
+        html = self.memory.get(digest)
+        if html is not None:
+            return html
+        if self.directory:
+            try:
+                with open(self.__path(paste.contentHash(), digest), 'r', encoding='utf-8') as f:
+                    html = f.read()
+            except OSError:
+                return None
+            self.memory.put(digest, html)
+            return html
+        return None
+
+    def put(self, paste, html, window=None):
+        """ Store the rendering of a paste (or of a window of its lines) """
+        digest = self.digest(paste, window)
+        self.memory.put(digest, html)
+        if self.directory:
+            try:
+                # Write to a temporary file first so readers never see half a file
+                fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    f.write(html)
+                os.replace(tmp, self.__path(paste.contentHash(), digest))
+            except OSError as e:
+                print("!! Error writing render cache for paste '{0}'".format(paste.id))
+                print(e)
+
+    def forget(self, content_hash):
+        """ Drop the persisted renderings of a content no paste has anymore.
+        The ones in memory can only be reached by that same content, they just age out """
+        if self.directory:
+            for path in glob.glob(os.path.join(self.directory, content_hash + ".*.html")):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def __path(self, content_hash, digest):
+        return os.path.join(self.directory, "{0}.{1}.html".format(content_hash, digest))
+
+    def __repr__(self):
+        return '<Render cache {0}>'.format(self.memory)
+
+class Renderer:
+    """ Highlights pastes in a pool of worker processes
+
+    Pygments is CPU bound, so rendering in the request threads would hold the
+    GIL and block a CherryPy worker for seconds on big pastes. Finished
+    renderings go to the RenderCache.
+    """
+
+    def __init__(self, cache, workers=RENDER_WORKERS):
+        self.cache = cache
+        self.workers = workers
+        self.executor = None # Started on first use, after cherrypy has daemonized
+        self.pending = {}    # render cache digest -> future, identical pastes are rendered once
+        self.lock = threading.Lock()
+
+    def submit(self, paste, window=None):
+        """ Render a paste (or a window of its lines), small ones right away and big ones in the background """
+        content = paste.text(window)
+        if len(content) <= INLINE_RENDER_MAX:
+            self.cache.put(paste, render(content, paste.language), window)
+            return
+        digest = self.cache.digest(paste, window)
+        with self.lock:
+            if digest in self.pending:
+                return
+            if self.executor is None:
+                self.executor = concurrent.futures.ProcessPoolExecutor(self.workers)
+            future = self.executor.submit(render, content, paste.language)
+            self.pending[digest] = future
+        future.add_done_callback(lambda f: self.__done(paste, window, digest, f))
+
+    def get(self, paste, window=None):
+        """ Return the rendering of a paste (or of a window of its lines), or None if it isn't ready yet """
+        rendered = self.cache.get(paste, window)
+        if rendered is None:
+            self.submit(paste, window)
+            rendered = self.cache.get(paste, window)
+        return rendered
+
+    def queued(self):
+        """ Return how many renderings are queued or running """
+        with self.lock:
+            return len(self.pending)
+
+    def shutdown(self):
+        """ Stop the worker processes """
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor:
+            executor.shutdown(wait=False)
+
+    def __done(self, paste, window, digest, future):
+        try:
+            if not paste.deleted:
+                self.cache.put(paste, future.result(), window)
+        except Exception as e:
+            print("!! Error rendering paste '{0}'".format(paste.id))
+            print(e)
+        finally:
+            with self.lock:
+                self.pending.pop(digest, None)
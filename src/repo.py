@@ -1,77 +1,417 @@
 #!/usr/bin/python3.4
-import glob
+import hashlib
 import os
 import random
 import string
 import re
-import hashlib
+import threading
 import time
-import pygments.lexers
-import tools
-from threading import Timer
-from db import DB
+import datetime
+import chunks
+import compression
+import detect
+import metrics
+import passwords
+import render
+from cache import LRUCache, PageCache
+from db import DB, DuplicateKey, SEARCH_MAX_CHARS
+from expiry import ExpiryScheduler
 
 db = DB()
+renders = render.RenderCache()
+renderer = render.Renderer(renders)
+
+schema = "id text PRIMARY KEY, content_hash text, author text, language text, password text, temporary boolean, created text, created_at timestamptz"
+
+# Paste ids are ID_LENGTH characters out of ID_ALPHABET
+ID_ALPHABET = string.ascii_lowercase + string.ascii_uppercase + string.digits
+ID_LENGTH = 10
+# How many ids to try before giving up, a collision is already very unlikely
+ID_ATTEMPTS = 5
+
+# Seconds before a temporary paste is deleted
+TEMPORARY_LIFETIME = 10800
+
+# Columns loaded with a paste, its content is only fetched when needed
+METADATA_COLUMNS = ('id', 'content_hash', 'author', 'language', 'password', 'temporary', 'created', 'created_at')
+
+# Columns of the pastes listed by PastesRepo.search(), and how many per page
+LIST_COLUMNS = ('id', 'author', 'language', 'password', 'temporary', 'created', 'created_at')
+LIST_PAGE_SIZE = 50
+
+# Bounds of the in-memory caches of pastes and of their (stored) contents
+CACHE_MAX_PASTES = 10000
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Pastes longer than this many lines are shown a page at a time
+PAGE_LINES = 1000
+# Most lines shown at once with ?lines=first-last
+MAX_WINDOW_LINES = 5000
+# Chunks read or written per query while streaming a chunked content
+STREAM_CHUNKS = 4
+
+# Biggest paste accepted, in utf-8 bytes. Set from max_paste_bytes in pasteit.conf
+MAX_PASTE_BYTES = 8 * 1024 * 1024
+# How many pastes are stored at once, and how long (seconds) the others wait for their turn
+MAX_CONCURRENT_CREATES = 4
+CREATE_WAIT_SECONDS = 10
+
+# Bound of the in-memory cache of whole paste pages
+PAGE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+pages = PageCache(PAGE_CACHE_MAX_BYTES)
+
+creates = threading.BoundedSemaphore(MAX_CONCURRENT_CREATES)
+
+class Busy(Exception):
+    """ Raised by PastesRepo.create when too many pastes are being created already """
+    pass
+
+def configure(config):
+    """ Read the paste size and create concurrency limits from the [pasteit] config section """
+    global MAX_PASTE_BYTES, MAX_CONCURRENT_CREATES, CREATE_WAIT_SECONDS, creates
+    MAX_PASTE_BYTES = int(config.get('max_paste_bytes', MAX_PASTE_BYTES))
+    CREATE_WAIT_SECONDS = float(config.get('create_wait_seconds', CREATE_WAIT_SECONDS))
+    MAX_CONCURRENT_CREATES = int(config.get('max_concurrent_creates', MAX_CONCURRENT_CREATES))
+    creates = threading.BoundedSemaphore(MAX_CONCURRENT_CREATES)
+
+metrics.cache('pages', pages.pages)
+metrics.cache('renders', renders.memory)
+metrics.register(lambda: [('render_queue', {}, renderer.queued())])
+
+def pool_metrics():
+    """ Connection pool usage, for /metrics """
+    stats = db.pool.stats()
+    return [('db_pool_connections', {'state': 'open'}, stats['open']),
+        ('db_pool_connections', {'state': 'idle'}, stats['idle']),
+        ('db_pool_connections', {'state': 'in_use'}, stats['in_use']),
+        ('db_pool_maxconn', {}, stats['maxconn']),
+        ('db_pool_waits_total', {}, stats['waits']),
+        ('db_pool_wait_seconds_total', {}, stats['wait_time']),
+        ('db_pool_timeouts_total', {}, stats['timeouts']),
+        ('db_reconnects_total', {}, stats['reconnects'])]
+
+metrics.register(pool_metrics)
+
+# Ids come from the OS randomness source, so they can't be predicted
+idgen = random.SystemRandom()
+
+# Tags the change notifications this process sends, so it can skip its own
+instance = '%08x' % idgen.getrandbits(32)
+
+def new_id():
+    """ Generate a random paste id """
+    return ''.join(idgen.choice(ID_ALPHABET) for i in range(ID_LENGTH))
 
-schema = "id text PRIMARY KEY, content text, author text, language text, password text, temporary boolean, created text"
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+def encode_cursor(created_at, id):
+    """ Encode the position after a listed paste, for the next page """
+    delta = created_at - EPOCH
+    return "{0}-{1}".format((delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds, id)
+
+def decode_cursor(cursor):
+    """ Decode a position from encode_cursor(), None if it's invalid """
+    try:
+        microseconds, id = cursor.split('-', 1)
+        return (EPOCH + datetime.timedelta(microseconds=int(microseconds)), id)
+    except (AttributeError, ValueError, OverflowError):
+        return None
+
+def expiration(created):
+    """ Return the unix time a temporary paste created at `created` expires """
+    return time.mktime(time.strptime(created, "%m/%d/%y at %H:%M:%S")) + TEMPORARY_LIFETIME
 
 class PastesRepo:
     """ A repository for all the registered pastes """
 
-    def __init__(self):
-        db.add_table('pastes', db.tables['pastes'][1])
-        
-        self.pastes = {} # Create the pastes' dict
-        self.scan() # Scan for available pastes
+    def __init__(self, max_pastes=CACHE_MAX_PASTES, max_bytes=CACHE_MAX_BYTES):
+        # The pastes table is created (if needed) by DB() at startup.
+        # Pastes are loaded on demand by get() and kept in a bounded cache
+        self.pastes = LRUCache(max_items=max_pastes)
+        # Their contents are cached apart, by hash (and chunk number), so pastes with the same content share it
+        self.blobs = LRUCache(max_bytes=max_bytes)
+        # The (lines, size, line index) of the contents, by hash
+        self.layouts = LRUCache(max_items=max_pastes)
+        # A single thread deletes temporary pastes when they expire
+        self.expiry = ExpiryScheduler(self.expire)
+        metrics.cache('pastes', self.pastes)
+        metrics.cache('blobs', self.blobs)
+        metrics.register(lambda: [('expiry_scheduled', {}, self.expiry.depth()),
+                                  ('expired_total', {}, self.expiry.expired),
+                                  ('threads', {}, threading.active_count())])
+        self.schedule_temporary()
+        self.expiry.start()
+        # Other processes serving the same DB tell us when they change a paste
+        db.listen('pastes', self.changed)
+
+    def announce(self, id):
+        """ Tell the other processes that a paste changed """
+        db.notify('pastes', instance + ' ' + id)
+
+    def changed(self, payload):
+        """ Forget what we know about a paste changed by another process """
+        sender, id = payload.split(' ', 1)
+        if sender == instance:
+            return
+        self.pastes.pop(id)
+        pages.invalidate(id)
+        rows = db.get_data('pastes', 'id', id, columns=('temporary', 'created'))
+        if rows and rows[0][0]:
+            self.expiry.schedule(id, expiration(rows[0][1]))
+        else:
+            self.expiry.cancel(id)
+
+    def schedule_temporary(self):
+        """ Schedule the expiry of the temporary pastes in the DB, from their creation time """
+        rows = db.get_data('pastes', 'temporary', True, columns=('id', 'created')) or []
+        for id, created in rows:
+            self.expiry.schedule(id, expiration(created))
+        print("Scheduled {0} temporary pastes for expiry.".format(len(rows)))
 
-    def scan(self):
-        """ Scan for available pastes """
-        pastes = db.get_all_data('pastes') # Find all pastes rows
-        # Create a representation for each paste
-        for paste in pastes:
-            self.pastes[paste[0]] = Paste(self, paste[0]) #TODO: NOTE: THIS IS WHAT Paste() SHOULD ACCEPT
+    def expire(self, id):
+        """ Delete a temporary paste whose time is up """
+        # Check the DB copy, the paste may have been made permanent meanwhile
+        rows = db.get_data('pastes', 'id', id, columns=('temporary', 'created', 'content_hash'))
+        if rows and rows[0][0]:
+            if expiration(rows[0][1]) <= time.time():
+                self.remove(id)
+                print("Expired paste '{0}'.".format(id))
+            else:
+                self.expiry.schedule(id, expiration(rows[0][1]))
 
     def create(self, content, password, author, language, temporary=False):
-        """ Create a new paste """
-        # Generate the paste identifier
-        pattern = string.ascii_lowercase+string.ascii_uppercase+string.digits # Alphanumeric pattern
-        while 1:
-            id = ''.join( random.sample(pattern, 10) ) # Generate the id
-            # If the id does not exist yet break the while
-            if not self.exists(id):
-                break
+        """ Create a new paste. The content is a str, or a binary file of utf-8 text (i.e. a spooled
+        upload), which big pastes are read from a chunk at a time instead of as a whole """
         # Validate author
         if not re.match(r"^([A-Za-z0-9 \.'àèéìòùÀÈÉÌÒÙ]+)$", author):
             raise ValueError('Invalid author')
-        # Create the paste
-        paste = Paste(self)
-        paste.id = id
-        paste.author = author
-        paste.content = content
-        paste.language = language
-        paste.temporary = temporary
-        if paste.temporary:
-            paste.timer = Timer(10800, lambda p: print(str(p.delete()) + " delete"), [paste])
-            paste.timer.start()
-            print("Created paste '{0}' with a timer.".format(paste.id))
-        if password:
-            paste.password = hashlib.sha1(password.encode('utf-8')).hexdigest() # Hash with sha1
+        # Validate language, before anything is stored: the ones of languages.json with a lexer, or "guess"
+        if language != "guess" and language not in dict(detect.languages):
+            raise ValueError('Invalid language')
+        if isinstance(content, str):
+            upload, data = None, content.encode('utf-8')
+            size = len(data)
         else:
-            paste.password = ""
-        paste.save()
-        self.pastes[id] = paste
+            upload, content, data = content, None, None
+            upload.seek(0, os.SEEK_END)
+            size = upload.tell()
+            upload.seek(0)
+        if size > MAX_PASTE_BYTES:
+            raise ValueError('The paste is too big, the limit is {0} KB'.format(MAX_PASTE_BYTES // 1024))
+        if upload is not None and size <= chunks.CHUNKED_MIN:
+            # Small enough to handle in memory
+            data = upload.read()
+            try:
+                content = data.decode('utf-8')
+            except UnicodeDecodeError:
+                raise ValueError('The paste is not valid UTF-8 text')
+        # Only a few pastes are stored at once, the others wait for their turn or are turned away
+        gate = creates
+        if not gate.acquire(timeout=CREATE_WAIT_SECONDS):
+            raise Busy('Too many pastes being created')
+        try:
+            # Create the paste
+            paste = Paste(self)
+            paste.author = author
+            paste.temporary = temporary
+            if password:
+                paste.password = passwords.hash(password) # Salted, slow hash
+            else:
+                paste.password = ""
+            # Store the content, or just count one more use if it's already stored
+            if content is not None:
+                paste.content_hash = compression.content_hash(data)
+                self.__store(paste.content_hash, content, data)
+                sample = content
+            else:
+                paste.content_hash, layout, sample = self.__scan(upload)
+                self.__store_upload(paste.content_hash, layout, sample, upload)
+            # Detect the language once, here, instead of on every view
+            if language == "guess":
+                language = detect.detect(sample)
+            paste.language = language
+            # Insert it with a fresh id, picking another one in the unlikely case it's taken
+            for attempt in range(ID_ATTEMPTS):
+                paste.id = new_id()
+                try:
+                    if not paste.insert():
+                        self.release(paste.content_hash)
+                        raise ValueError('Could not save the paste')
+                    break
+                except DuplicateKey:
+                    print("Paste id '{0}' already taken, retrying.".format(paste.id))
+            else:
+                self.release(paste.content_hash)
+                raise ValueError('Could not generate a paste id')
+        finally:
+            gate.release()
+        id = paste.id
+        self.pastes.put(id, paste)
+        if paste.temporary:
+            self.expiry.schedule(id, paste.expiresAt())
+            self.announce(id)
+            print("Created temporary paste '{0}'.".format(paste.id))
+        # Highlight it (its first page, if it's paged) in the background, so it's ready by the first view
+        renderer.submit(paste, paste.window())
         return id
 
+    def __store(self, content_hash, content, data):
+        # Store a content held in memory, big ones in chunks (see chunks.py). data is its utf-8 encoding
+        if len(data) > chunks.CHUNKED_MIN:
+            parts = chunks.split(content)
+            blob, line_index = None, [first for first, text in parts]
+        else:
+            blob, line_index = compression.pack(data), None
+        layout = (chunks.count_lines(content), len(data), line_index)
+        row = {'hash': content_hash, 'content': blob, 'lines': layout[0], 'size': layout[1], 'line_index': line_index}
+        if self.__add_blob(row, (lambda: parts) if line_index is not None else None, content):
+            # Only ours when we stored it, a content stored before (i.e. by an older version) keeps its
+            #   own layout, which is read from its row when needed
+            if blob is not None:
+                self.blobs.put(content_hash, blob)
+            self.layouts.put(content_hash, layout)
+
+    def __scan(self, upload):
+        # Read an uploaded content once, a chunk at a time, for its hash, layout and first characters
+        #   (to detect its language and index it for search)
+        digest = hashlib.sha256()
+        size = 0
+        line_index = []
+        sample = []
+        sampled = 0
+        last = ""
+        upload.seek(0)
+        try:
+            for first, text in chunks.split_blocks(chunks.decode(upload)):
+                data = text.encode('utf-8')
+                digest.update(data)
+                size += len(data)
+                line_index.append(first)
+                last = text
+                if sampled < SEARCH_MAX_CHARS:
+                    sample.append(text[:SEARCH_MAX_CHARS - sampled])
+                    sampled += len(sample[-1])
+        except UnicodeDecodeError:
+            raise ValueError('The paste is not valid UTF-8 text')
+        lines = line_index[-1] - 1 + chunks.count_lines(last) if line_index else 0
+        return digest.hexdigest(), (lines, size, line_index), "".join(sample)
+
+    def __store_upload(self, content_hash, layout, sample, upload):
+        # Store an uploaded content in chunks, reading it again for them (the search index gets its beginning)
+        def parts():
+            upload.seek(0)
+            return chunks.split_blocks(chunks.decode(upload))
+        row = {'hash': content_hash, 'content': None, 'lines': layout[0], 'size': layout[1], 'line_index': layout[2]}
+        if self.__add_blob(row, parts, sample):
+            # As in __store, the layout of a content stored before is read from its row
+            self.layouts.put(content_hash, layout)
+
+    def __add_blob(self, row, parts, text):
+        # Count one more use of a stored content, or store it. parts() returns the (first line, text) chunks
+        #   of a chunked content: they're written before its blobs row, so no paste can point to a content
+        #   whose chunks are still being written (or failed to be). Returns True if the content is new
+        content_hash = row['hash']
+        refs = db.add_reference('blobs', row, 'hash', 'refs', insert=False)
+        if refs is False:
+            raise ValueError('Could not save the paste')
+        if refs:
+            return False
+        if parts is not None:
+            self.__add_chunks(content_hash, parts())
+        refs = db.add_reference('blobs', row, 'hash', 'refs')
+        if not refs:
+            raise ValueError('Could not save the paste')
+        if refs > 1:
+            # Stored by another create meanwhile, after its chunks
+            return False
+        if parts is not None and db.count_data('chunks', 'hash', content_hash) < len(row['line_index']):
+            # Another create stored the same content meanwhile and its paste was deleted, along with the
+            #   chunks (ours too). The blobs row holds them now, write them again
+            try:
+                self.__add_chunks(content_hash, parts())
+            except ValueError:
+                self.release(content_hash)
+                raise
+        # A new content, make it searchable
+        db.index_text('blobs', 'hash', content_hash, 'search', text)
+        return True
+
+    def __add_chunks(self, content_hash, parts):
+        # Write the chunks STREAM_CHUNKS at a time. The ones already there (from a create of the same
+        #   content) are skipped, as are the ones a failed create leaves behind
+        rows = []
+        for number, (first, text) in enumerate(parts):
+            rows.append({'hash': content_hash, 'number': number, 'content': compression.pack(text)})
+            if len(rows) == STREAM_CHUNKS:
+                if not db.add_many('chunks', rows, ignore_duplicates=True):
+                    raise ValueError('Could not save the paste')
+                rows = []
+        if not db.add_many('chunks', rows, ignore_duplicates=True):
+            raise ValueError('Could not save the paste')
+
+    def remove(self, id):
+        """ Delete a paste from the DB and the caches, and its content if no other paste has it """
+        deleted = db.delete_paste(id)
+        # After the delete, so a request loading the paste meanwhile can't cache it again
+        self.pastes.pop(id)
+        pages.invalidate(id)
+        if deleted:
+            content_hash, refs = deleted
+            if content_hash and refs == 0:
+                self.forget(content_hash)
+            self.announce(id)
+
+    def release(self, content_hash):
+        """ Count one less use of a stored content not held by a paste (i.e. of a failed create),
+        deleting it when no paste has it anymore """
+        if db.drop_reference('blobs', 'hash', content_hash, 'refs', cascade=[('chunks', 'hash')]) == 0:
+            self.forget(content_hash)
+
+    def forget(self, content_hash):
+        """ Drop the cached copies of a deleted content """
+        # Its cached chunks can only be reached by that same content, they just age out
+        self.blobs.pop(content_hash)
+        self.layouts.pop(content_hash)
+        renders.forget(content_hash)
+
+    def search(self, author=None, language=None, since=None, until=None, text=None, after=None, limit=LIST_PAGE_SIZE):
+        """ List pastes, newest first, optionally by author, language, creation time range
+        and full text search of the content. Returns a page of pastes (as dicts of LIST_COLUMNS)
+        and the cursor to pass as `after` for the next page, None on the last one """
+        filters = {}
+        if author:
+            filters['author'] = author
+        if language:
+            filters['language'] = language
+        rows = db.list_pastes(LIST_COLUMNS, filters, since, until, text,
+                              decode_cursor(after) if after else None, limit + 1) or []
+        pastes = [dict(zip(LIST_COLUMNS, row)) for row in rows[:limit]]
+        next = None
+        if len(rows) > limit:
+            next = encode_cursor(pastes[-1]['created_at'], pastes[-1]['id'])
+        return pastes, next
+
     def exists(self, id):
         """ Check if a paste exists """
-        if db.get_data('pastes', 'id', id):
+        if db.get_data('pastes', 'id', id, columns=('id', )):
             return True
         else:
             return False
 
     def get(self, id):
-        """ Get a paste by id """
-        return self.pastes[id]
+        """ Get a paste by id, loading it from the DB if it isn't cached """
+        paste = self.pastes.get(id)
+        if paste is None:
+            try:
+                paste = Paste(self, id)
+            except FileNotFoundError:
+                raise KeyError(id)
+            # Expired temporary pastes are deleted while loading
+            if paste.deleted:
+                raise KeyError(id)
+            self.pastes.put(id, paste)
+        return paste
 
     def __repr__(self):
         return '<Pastes repository>'
@@ -81,6 +421,8 @@ class Paste:
 
     def __init__(self, repo, id=None):
         self.loaded = False
+        self.deleted = False
+        self.content_hash = None
         self.repo = repo
         # If an id is provided, load the paste from it
         if id:
@@ -88,65 +430,200 @@ class Paste:
         else:
             self.id = None
             self.author = ""
-            self.content = None
             self.password = None
             self.language = None
             self.temporary = False
             self.created = time.strftime("%m/%d/%y at %H:%M:%S")
+            self.created_at = datetime.datetime.now(datetime.timezone.utc)
         self.loaded = True
 
     def load(self, id):
         """ Load the paste from the DB """
         if not self.loaded:
-            if db.check_table('pastes'):
-                # Read the file content
-                data = db.get_data('pastes', 'id', id)[0]
-                if not data:
-                    raise FileNotFoundError('Paste not found: '+id)
-                else:
-                    self.id = data[0]
-                    self.content = data[1]
-                    self.author = data[2]
-                    self.language = data[3]
-                    self.password = data[4]
-                    self.temporary = data[5]
-                    self.created = data[6]
-                    
-                    if self.temporary:
-                        if time.mktime(time.localtime()) - 10800 > self.createdAt(formatted=False):
-                            print("Cleaned up paste '{0}'.".format(self.id))
-                            self.delete()
-                        else:
-                            self.timer = Timer(10800, lambda p: print(str(p.delete()) + " delete"), [self])
-                            self.timer.start()
-                            print("Loaded paste '{0}' with a timer.".format(self.id))
-                    else:
-                        print("Loaded paste '{0}'.".format(self.id))
-            else:
+            # Read the paste metadata, a single small query (table existence is known from startup).
+            # The content is loaded on first access, auth checks and redirects never need it
+            rows = db.get_data('pastes', 'id', id, columns=METADATA_COLUMNS)
+            if not rows:
                 raise FileNotFoundError('Paste not found: '+id)
+            else:
+                data = rows[0]
+                self.id = data[0]
+                self.content_hash = data[1]
+                self.author = data[2]
+                self.language = data[3]
+                self.password = data[4]
+                self.temporary = data[5]
+                self.created = data[6]
+                self.created_at = data[7]
+                if self.language == "guess":
+                    # Stored before languages were detected on creation, detect it once now
+                    self.language = detect.detect(self.content)
+                    db.update_data('pastes', 'language', self.language, 'id', self.id)
+                
+                if self.temporary:
+                    if self.expiresAt() <= time.time():
+                        print("Cleaned up paste '{0}'.".format(self.id))
+                        self.delete()
+                    else:
+                        self.repo.expiry.schedule(self.id, self.expiresAt())
+                        print("Loaded temporary paste '{0}'.".format(self.id))
+                else:
+                    print("Loaded paste '{0}'.".format(self.id))
         else:
             raise RuntimeError('Paste already loaded')
 
-    def save(self):
-        """ Save the paste """
-        data = {'id': self.id,
-            'content': self.content,
+    def row(self):
+        """ Get the DB row of the paste """
+        return {'id': self.id,
+            'content_hash': self.content_hash,
             'author': self.author,
             'language': self.language,
             'password': self.password,
             'temporary': self.temporary,
-            'created': self.created}
-        
-        if db.get_data('pastes', 'id', self.id):
-            db.delete_data('pastes', 'id', self.id)
-        db.add_data('pastes', data)
+            'created': self.created,
+            'created_at': self.created_at}
+
+    def insert(self):
+        """ Save a new paste, raises DuplicateKey if the id is already taken """
+        return db.add_unique('pastes', self.row())
+
+    def save(self):
+        """ Save the paste """
+        # Insert or update in place, in one statement
+        db.upsert_data('pastes', self.row())
+        pages.invalidate(self.id)
+        self.repo.announce(self.id)
 
     def delete(self):
         """ Delete the paste """
         print("Deleting paste '{0}'.".format(self.id))
-        if self.id in self.repo.pastes:
-            self.repo.pastes.pop(self.id)
-        db.delete_data('pastes', 'id', self.id)
+        self.deleted = True
+        self.repo.expiry.cancel(self.id)
+        self.repo.remove(self.id)
+
+    def stored(self):
+        """ Get the content as stored (see compression.py), fetching it on first access.
+        None for contents stored in chunks """
+        if not self.content_hash:
+            return None
+        blob = self.repo.blobs.get(self.content_hash)
+        if blob is None:
+            layout = self.repo.layouts.get(self.content_hash)
+            if layout is not None and layout[2] is not None:
+                return None
+            blob, layout = self.__fetch()
+        return blob
+
+    def layout(self):
+        """ Get the (lines, size in bytes, line index) of the content. The line index is the
+        first line of each chunk, None if the content isn't stored in chunks """
+        if not self.content_hash:
+            return (0, 0, None)
+        layout = self.repo.layouts.get(self.content_hash)
+        if layout is None:
+            blob, layout = self.__fetch()
+        return layout
+
+    def __fetch(self):
+        # Read the blob of the content: whole contents go to the blobs cache, the layout to the layouts cache
+        rows = db.get_data('blobs', 'hash', self.content_hash, columns=('content', 'lines', 'size', 'line_index'))
+        if not rows:
+            # Empty if the paste was deleted meanwhile
+            return compression.pack(""), (0, 0, None)
+        content, lines, size, line_index = rows[0]
+        blob = bytes(content) if content is not None else None
+        if lines is None:
+            # Stored by an older version, before the migration filled these in
+            text = compression.unpack(blob)
+            lines, size = chunks.count_lines(text), len(text.encode('utf-8'))
+        layout = (lines, size, line_index)
+        if blob is not None:
+            self.repo.blobs.put(self.content_hash, blob)
+        self.repo.layouts.put(self.content_hash, layout)
+        return blob, layout
+
+    def chunkTexts(self, first, last):
+        """ Get the text of chunks first to last (inclusive) of a chunked content """
+        keys = [(self.content_hash, number) for number in range(first, last + 1)]
+        blobs = dict((key, self.repo.blobs.get(key)) for key in keys)
+        missing = [key[1] for key in keys if blobs[key] is None]
+        if missing:
+            for number, content in db.get_chunks(self.content_hash, missing[0], missing[-1]) or []:
+                blobs[(self.content_hash, number)] = bytes(content)
+                self.repo.blobs.put((self.content_hash, number), bytes(content))
+        return [compression.unpack(blobs[key]) for key in keys if blobs[key] is not None]
+
+    def stream(self):
+        """ Yield the content as utf-8 bytes, a few chunks at a time """
+        line_index = self.layout()[2]
+        if line_index is None:
+            yield self.content.encode('utf-8')
+            return
+        for first in range(0, len(line_index), STREAM_CHUNKS):
+            for text in self.chunkTexts(first, min(first + STREAM_CHUNKS, len(line_index)) - 1):
+                yield text.encode('utf-8')
+
+    @property
+    def content(self):
+        """ The paste text, fetched and decompressed on access. It's kept compressed in memory and in the DB """
+        line_index = self.layout()[2]
+        if line_index is not None:
+            return "".join(self.chunkTexts(0, len(line_index) - 1))
+        blob = self.stored()
+        if blob is None:
+            return None
+        return compression.unpack(blob)
+
+    def gzipped(self):
+        """ Get the content as stored gzip stream (to send as is), or None if it's stored uncompressed or in chunks """
+        blob = self.stored()
+        if blob is None:
+            return None
+        return compression.gzipped(blob)
+
+    def isChunked(self):
+        """ Check if the content is stored in chunks """
+        return self.layout()[2] is not None
+
+    def lineCount(self):
+        return self.layout()[0]
+
+    def size(self):
+        """ Get the size of the content in utf-8 bytes """
+        return self.layout()[1]
+
+    def lines(self, first, last):
+        """ Get the text of lines first to last (inclusive, from 1), reading only the chunks holding them """
+        line_index = self.layout()[2]
+        if line_index is None:
+            return chunks.select_lines(self.content, 1, first, last)
+        start, stop = chunks.locate(line_index, first), chunks.locate(line_index, last)
+        return chunks.select_lines("".join(self.chunkTexts(start, stop)), line_index[start], first, last)
+
+    def window(self, lines=None, page=None):
+        """ Get the (first, last) lines to show for the `lines` ("first-last") or `page` (from 1)
+        arguments of a view. Without either, pastes over PAGE_LINES lines show their first page
+        and the others are shown whole (None). Raises ValueError on invalid arguments """
+        total = self.lineCount()
+        if lines:
+            first, sep, last = lines.partition('-')
+            first = int(first)
+            last = int(last) if last else first
+            last = min(last, first + MAX_WINDOW_LINES - 1)
+        elif page:
+            page = int(page)
+            first, last = (page - 1) * PAGE_LINES + 1, page * PAGE_LINES
+        elif total > PAGE_LINES or self.isChunked():
+            first, last = 1, PAGE_LINES
+        else:
+            return None
+        if first < 1 or last < first or first > max(total, 1):
+            raise ValueError('Invalid lines')
+        return (first, min(last, max(total, 1)))
+
+    def contentHash(self):
+        """ Get the hash of the content, which never changes once saved """
+        return self.content_hash
 
     def createdAt(self, formatted=True):
         """ Get the creation date """
@@ -159,18 +636,54 @@ class Paste:
         else:
             return time.mktime(time.strptime(self.created, "%m/%d/%y at %H:%M:%S"))
 
-    def formattedContent(self):
-        """ Return the formatted paste content """
-        # Detect which lexer use
-        if self.language == "guess":
-            try:
-                lexer = pygments.lexers.guess_lexer(self.content)
-            except Exception:
-                lexer = pygments.lexers.get_lexer_by_name("text")
+    def expiresAt(self):
+        """ Get the time a temporary paste expires at """
+        return expiration(self.created)
+
+    def neighbours(self, window):
+        """ Get the lines arguments ("first-last") of the pages before and after a window, None at either end """
+        first, last = window
+        total = self.lineCount()
+        previous = "{0}-{1}".format(max(first - PAGE_LINES, 1), first - 1) if first > 1 else None
+        next = "{0}-{1}".format(last + 1, min(last + PAGE_LINES, total)) if last < total else None
+        return previous, next
+
+    def renderWindows(self, window):
+        """ Get the windows rendered to show a window of lines: the pages of PAGE_LINES lines it
+        overlaps. Any other window is cut out of those, instead of being rendered and stored apart """
+        total = max(self.lineCount(), 1)
+        return [(page * PAGE_LINES + 1, min((page + 1) * PAGE_LINES, total))
+                for page in range((window[0] - 1) // PAGE_LINES, (window[1] - 1) // PAGE_LINES + 1)]
+
+    def formattedContent(self, window=None):
+        """ Return the formatted paste content (or the lines of a window of it), or the escaped
+        plain content while it's being highlighted """
+        if window is None:
+            html = renderer.get(self)
         else:
-            lexer = pygments.lexers.get_lexer_by_name(self.language)
-        # Return the formatted output
-        return tools.highlight(self.content, lexer)
+            pages = self.renderWindows(window)
+            renderings = [renderer.get(self, page) for page in pages]
+            if None in renderings:
+                html = None
+            elif pages == [window]:
+                html = renderings[0]
+            else:
+                html = render.cut(renderings, pages[0][0], *window)
+        if html is None:
+            return render.fallback(self.text(window))
+        return html
+
+    def text(self, window=None):
+        """ Get the content, or the lines of a window of it """
+        if window is None:
+            return self.content
+        return self.lines(*window)
+
+    def isRendered(self, window=None):
+        """ Check if the highlighted content is ready """
+        if window is None:
+            return renders.get(self) is not None
+        return all(renders.get(self, page) is not None for page in self.renderWindows(window))
 
     def __str__(self):
         return self.formattedContent()
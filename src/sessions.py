@@ -0,0 +1,64 @@
+#!/usr/bin/python3.4
+import pickle
+import cherrypy
+import psycopg2
+import cherrypy.lib.sessions
+import metrics
+import repo
+
+class PostgresSession(cherrypy.lib.sessions.Session):
+    """ Sessions stored in the db's sessions table, shared by every worker process
+
+    Enable with tools.sessions.storage_type = "postgres". Sessions aren't
+    locked across processes: concurrent requests of the same client both
+    save, and the last one wins, which is fine for the few flags we keep.
+    """
+
+    pickle_protocol = pickle.HIGHEST_PROTOCOL
+
+    @metrics.timed('session')
+    def _exists(self):
+        # Only the id from the request's cookie is looked up. The ones made for a new session are
+        #   random enough not to be taken already, so a request without a cookie doesn't query the db
+        if self.id != self.originalid:
+            return False
+        return bool(repo.db.get_data('sessions', 'id', self.id, columns=('id', )))
+
+    @metrics.timed('session')
+    def _load(self):
+        if self.id != self.originalid:
+            return None # a new session (see _exists)
+        rows = repo.db.get_data('sessions', 'id', self.id, columns=('data', 'expiration_time'))
+        if not rows:
+            return None
+        try:
+            return (pickle.loads(bytes(rows[0][0])), rows[0][1])
+        except Exception as e:
+            print("!! Error loading session data")
+            print(e)
+            return None
+
+    @metrics.timed('session')
+    def _save(self, expiration_time):
+        data = pickle.dumps(self._data, self.pickle_protocol)
+        repo.db.upsert_data('sessions', {'id': self.id, 'data': psycopg2.Binary(data), 'expiration_time': expiration_time})
+
+    @metrics.timed('session')
+    def _delete(self):
+        repo.db.delete_data('sessions', 'id', self.id)
+
+    def acquire_lock(self):
+        self.locked = True
+
+    def release_lock(self):
+        self.locked = False
+
+    def clean_up(self):
+        """ Delete the expired sessions """
+        repo.db.delete_older_than('sessions', 'expiration_time', self.now())
+
+    def __len__(self):
+        return repo.db.count_data('sessions')
+
+# cherrypy looks storage types up by name in its sessions module
+cherrypy.lib.sessions.PostgresSession = PostgresSession
@@ -1,29 +1,233 @@
 #!/usr/bin/python3.4
+import functools
+import os
 import cherrypy
+import cherrypy._cpreqbody
+import cherrypy.lib.httputil
 import jinja2
 import pygments
 import pygments.lexers
 import pygments.formatters
+import detect
+import metrics
+import ratelimit
 
 # The jinja2 enviroment
 jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader('views'))
 
+# Templates compiled at startup by configure(), name -> template
+templates = {}
+
+# Biggest request body accepted, set from max_request_bytes in pasteit.conf
+MAX_REQUEST_BYTES = 9 * 1024 * 1024
+# Paste contents bigger than this are spooled to a temporary file instead of being kept in memory,
+#   the other form fields can't be bigger
+SPOOL_MIN = 64 * 1024
+
+def configure(config):
+    """ Set up template loading and the request size limit from the [pasteit] config section
+
+    Unless templates_reload is on, every template is compiled once here and
+    never checked for changes again, so rendering does no file system calls.
+    templates_cache is a directory to keep compiled templates in between
+    restarts (and share them between worker processes).
+    """
+    jinja_env.auto_reload = bool(config.get('templates_reload', False))
+    if config.get('templates_cache'):
+        os.makedirs(config['templates_cache'], exist_ok=True)
+        jinja_env.bytecode_cache = jinja2.FileSystemBytecodeCache(config['templates_cache'])
+    global MAX_REQUEST_BYTES
+    MAX_REQUEST_BYTES = int(config.get('max_request_bytes', MAX_REQUEST_BYTES))
+    templates.clear()
+    if not jinja_env.auto_reload:
+        for name in jinja_env.list_templates():
+            templates[name] = jinja_env.get_template(name)
+
+def get_template(name):
+    """ Get a compiled template """
+    tmpl = templates.get(name)
+    if tmpl is None:
+        tmpl = jinja_env.get_template(name)
+    return tmpl
+
 def template(name):
     """ Decorator which render the template passed to it with all arguments returned from the function """
     def decorator(f):
+        @functools.wraps(f)
         def wrapper(*args, **kwargs):
             result = f(*args, **kwargs) # Execute the function
             # If the function return nothing, suppose it want to return an empty dict
             if not result:
                 result = {}
-            tmpl = jinja_env.get_template(name) # Prepare the template
-            return tmpl.render(**result) # Return the rendered version of it
+            with metrics.stage('template'):
+                tmpl = get_template(name) # Prepare the template
+                return tmpl.render(**result) # Return the rendered version of it
         return wrapper
     return decorator
 
-def highlight(content, language):
-    """ Return an highlighted content """
+@metrics.timed('highlight')
+def highlight(content, language, **options):
+    """ Return an highlighted content, options are passed to the HtmlFormatter """
     # If the language is guess try to guess it
     if language == "guess":
-        language = pygments.lexers.guess_lexer(content)
-    return pygments.highlight(content, language, pygments.formatters.HtmlFormatter())
+        language = pygments.lexers.get_lexer_by_name(detect.detect(content), stripnl=False)
+    return pygments.highlight(content, language, pygments.formatters.HtmlFormatter(**options))
+
+# Size of the chunks streamed bodies are sent in
+CHUNK_SIZE = 64 * 1024
+
+def serve_bytes(data, content_type, etag, last_modified=None, cache_control="no-cache", gzipped=None):
+    """ Serve a body with validators: 304 on a matching If-None-Match, 206 for a single byte Range
+
+    If a gzipped copy of the body is given, it's sent to clients accepting it
+    (range requests always get the identity body).
+    Returns an iterable of chunks, for handlers with response.stream on.
+    """
+    request = cherrypy.request
+    response = cherrypy.response
+    range_header = request.headers.get('Range')
+    if gzipped is not None:
+        response.headers['Vary'] = 'Accept-Encoding'
+        if not range_header and accepts_gzip():
+            # Each encoding is a different representation, with its own ETag
+            data = gzipped
+            etag = etag + '-gz'
+            response.headers['Content-Encoding'] = 'gzip'
+    etag = '"' + etag + '"'
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = cache_control
+    no_shared_cookie(cache_control)
+    response.headers['Accept-Ranges'] = 'bytes'
+    if last_modified:
+        response.headers['Last-Modified'] = cherrypy.lib.httputil.HTTPDate(last_modified)
+    # The client already has it
+    if not_modified(etag):
+        response.status = 304
+        response.headers.pop('Content-Encoding', None)
+        return []
+    response.headers['Content-Type'] = content_type
+    start, stop = 0, len(data)
+    # Ranges of an outdated version are ignored, the whole body is sent
+    if range_header and request.headers.get('If-Range', etag) == etag:
+        ranges = cherrypy.lib.httputil.get_ranges(range_header, len(data))
+        if ranges == []:
+            response.headers['Content-Range'] = 'bytes */%d' % len(data)
+            raise cherrypy.HTTPError(416)
+        # Multiple ranges aren't worth a multipart body, send everything
+        if ranges and len(ranges) == 1:
+            start, stop = ranges[0]
+            response.status = 206
+            response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, len(data))
+    response.headers['Content-Length'] = stop - start
+    return stream(data, start, stop)
+
+def serve_chunks(chunks, length, content_type, etag, last_modified=None, cache_control="no-cache"):
+    """ Serve a body of a known length from an iterable of byte chunks, without holding all of it.
+    Answers 304 on a matching If-None-Match, ranges aren't supported so the whole body is sent """
+    response = cherrypy.response
+    etag = '"' + etag + '"'
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = cache_control
+    no_shared_cookie(cache_control)
+    response.headers['Accept-Ranges'] = 'none'
+    if last_modified:
+        response.headers['Last-Modified'] = cherrypy.lib.httputil.HTTPDate(last_modified)
+    if not_modified(etag):
+        response.status = 304
+        return []
+    response.headers['Content-Type'] = content_type
+    response.headers['Content-Length'] = length
+    return chunks
+
+def has_session():
+    """ Check if the request carries a session cookie. Reading cherrypy.session without one starts (and stores) a new session """
+    request = cherrypy.request
+    return request.config.get('tools.sessions.name', 'session_id') in request.cookie
+
+def no_shared_cookie(cache_control):
+    """ Drop the session cookie from responses shared caches may keep, or a CDN would hand
+    the same session (and whoever logs in on it later) to every visitor """
+    if cache_control.startswith('public'):
+        cherrypy.response.cookie.pop(cherrypy.request.config.get('tools.sessions.name', 'session_id'), None)
+
+def not_modified(etag):
+    """ Check if the request's If-None-Match matches an ETag """
+    if_none_match = cherrypy.request.headers.get('If-None-Match')
+    return bool(if_none_match) and (if_none_match.strip() == '*' or etag in [t.strip() for t in if_none_match.split(',')])
+
+def stream(data, start, stop):
+    """ Yield data[start:stop] in chunks """
+    view = memoryview(data)
+    for offset in range(start, stop, CHUNK_SIZE):
+        yield bytes(view[offset:min(offset + CHUNK_SIZE, stop)])
+
+def accepts_gzip():
+    """ Check if the client accepts gzip encoded responses """
+    for element in cherrypy.request.headers.elements('Accept-Encoding'):
+        if element.value in ('gzip', '*') and element.qvalue > 0:
+            return True
+    return False
+
+def limit_body(maxbytes=None):
+    """ Refuse request bodies bigger than maxbytes (MAX_REQUEST_BYTES by default) with a 413: right away
+    when the Content-Length says so, otherwise once that much has been read. Enabled with tools.body_limit.on """
+    maxbytes = maxbytes or MAX_REQUEST_BYTES
+    request = cherrypy.request
+    length = request.headers.get('Content-Length', '')
+    if length.isdigit() and int(length) > maxbytes:
+        # Don't read it, the connection is closed after the response
+        request.process_request_body = False
+        cherrypy.response.headers['Connection'] = 'close'
+        raise cherrypy.HTTPError(413, 'The request is bigger than {0} KB'.format(maxbytes // 1024))
+    request.body.maxbytes = maxbytes
+
+cherrypy.tools.body_limit = cherrypy.Tool('on_start_resource', limit_body)
+
+class SpooledPart(cherrypy._cpreqbody.Part):
+    """ A multipart form field that stays in its temporary file when it's too big to keep in memory
+
+    Only the fields named in `spooled` do: the handler gets the part itself
+    instead of a str for those, and can read its .file a block at a time.
+    Other fields that big are refused with a 413. Set with request.body.part_class.
+    """
+
+    maxrambytes = SPOOL_MIN
+    spooled = ('content', )
+
+    def fullvalue(self):
+        if self.file:
+            if self.name not in self.spooled:
+                raise cherrypy.HTTPError(413, 'The {0} field is bigger than {1} KB'.format(self.name, SPOOL_MIN // 1024))
+            self.file.seek(0)
+            return self
+        return cherrypy._cpreqbody.Part.fullvalue(self)
+
+def rate_limit():
+    """ Answer 429 to clients over the rate limit of the route (named after its handler), see ratelimit.py.
+    Enabled with tools.ratelimit.on """
+    request = cherrypy.request
+    if request.handler is None:
+        return
+    route = getattr(getattr(request.handler, 'callable', None), '__name__', '*')
+    wait = ratelimit.check(request.remote.ip or '', route)
+    if wait:
+        response = cherrypy.response
+        response.status = 429
+        response.headers['Retry-After'] = str(int(wait) + 1)
+        response.headers['Content-Type'] = 'text/plain;charset=utf-8'
+        response.body = b'Too many requests, try again later.'
+        # Skip the body and the handler
+        request.process_request_body = False
+        request.handler = None
+
+cherrypy.tools.ratelimit = cherrypy.Tool('on_start_resource', rate_limit, priority=10)
+
+def start_metrics():
+    """ Time the request, see metrics.py. Enabled with tools.metrics.on """
+    metrics.begin()
+    cherrypy.request.hooks.attach('on_end_request', end_metrics)
+
+def end_metrics():
+    metrics.end(cherrypy.request.method, cherrypy.request.path_info, cherrypy.response.status)
+
+cherrypy.tools.metrics = cherrypy.Tool('on_start_resource', start_metrics)
@@ -0,0 +1,18 @@
+#!/usr/bin/python3.4
+# WSGI entry point, to serve PasteIt from several worker processes, i.e.:
+#
+#     gunicorn --pythonpath src --workers 4 --bind 0.0.0.0:$PORT wsgi:application
+#
+# Run it from the repository root (templates, languages.json and pasteit.conf
+# are looked up from there), and don't preload the app: every worker needs its
+# own db connections and background threads.
+# Set tools.sessions.storage_type = "postgres" in pasteit.conf, so logins and
+# unlocked pastes are shared by all the workers.
+import cherrypy
+import pasteit
+
+cherrypy.config.update({'environment': 'embedded'})
+cherrypy.server.unsubscribe() # The WSGI server handles the sockets
+
+application = pasteit.mount()
+cherrypy.engine.start()
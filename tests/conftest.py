@@ -0,0 +1,32 @@
+# The modules are imported as the app does, from src/ (and bench/ for the in-memory db),
+# with the repository root as the working directory for templates and config files
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+os.chdir(ROOT)
+
+import pytest
+import db
+from memorydb import MemoryDB
+
+# repo connects to the db on import, give it the in-memory one
+DB, db.DB = db.DB, lambda migrate=None: MemoryDB()
+import repo
+db.DB = DB
+
+@pytest.fixture
+def pastes(monkeypatch):
+    """ A PastesRepo on a fresh in-memory db, rendering right away and keeping renderings in memory only """
+    import render
+    import repo
+    monkeypatch.setattr(repo, 'db', MemoryDB())
+    monkeypatch.setattr(repo.renders, 'directory', None)
+    monkeypatch.setattr(render, 'INLINE_RENDER_MAX', 10 ** 9)
+    repo.renders.memory.clear()
+    repo.pages.pages.clear()
+    pastes = repo.PastesRepo()
+    yield pastes
+    pastes.expiry.stop()
@@ -0,0 +1,57 @@
+from cache import LRUCache, PageCache
+
+def test_least_recently_used_entries_go_first():
+    entries = LRUCache(max_items=2)
+    entries.put('a', 1)
+    entries.put('b', 2)
+    entries.get('a')
+    entries.put('c', 3)
+    assert 'b' not in entries
+    assert entries.get('a') == 1 and entries.get('c') == 3
+    assert entries.stats()['evictions'] == 1
+
+def test_size_bound():
+    entries = LRUCache(max_bytes=10)
+    assert entries.put('a', b'12345')
+    assert entries.put('b', b'12345')
+    assert entries.put('a', b'123') # replacing an entry counts its new size
+    assert entries.size == 8
+    assert entries.put('c', b'1234')
+    assert 'b' not in entries and entries.size == 7
+    # Entries bigger than the whole cache aren't kept, and don't evict the others
+    assert not entries.put('d', b'x' * 11)
+    assert 'd' not in entries and len(entries) == 2
+
+def test_invalidate_drops_every_variant():
+    pages = PageCache(max_bytes=10000)
+    pages.put('see', 'abc', b'page')
+    pages.put('see', 'abc', b'admin page', auth=True)
+    pages.put('raw', 'abc', b'raw')
+    pages.put('raw', 'other', b'raw')
+    pages.invalidate('abc')
+    assert pages.get('see', 'abc') is None
+    assert pages.get('see', 'abc', auth=True) is None
+    assert pages.get('raw', 'abc') is None
+    assert pages.get('raw', 'other').body == b'raw'
+
+def test_pages_of_a_paste_invalidated_meanwhile_are_not_kept():
+    pages = PageCache(max_bytes=10000)
+    since = pages.version()
+    pages.invalidate('abc')
+    page = pages.put('raw', 'abc', b'old content', since=since)
+    assert page.body == b'old content'
+    assert pages.get('raw', 'abc') is None
+    # Other pastes, and pages loaded after the invalidation, are kept
+    assert pages.put('raw', 'other', b'raw', since=since)
+    assert pages.get('raw', 'other') is not None
+    pages.put('raw', 'abc', b'new content', since=pages.version())
+    assert pages.get('raw', 'abc').body == b'new content'
+
+def test_forgotten_invalidations_still_refuse_older_pages():
+    pages = PageCache(max_bytes=10000, max_invalidated=1)
+    since = pages.version()
+    pages.invalidate('abc')
+    pages.invalidate('other') # pushes 'abc' out of the invalidations kept
+    assert 'abc' not in pages.invalidated
+    pages.put('raw', 'abc', b'old content', since=since)
+    assert pages.get('raw', 'abc') is None
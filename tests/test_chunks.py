@@ -0,0 +1,45 @@
+import io
+import pytest
+import chunks
+
+CONTENT = "short\n" + "a much longer line than a chunk\n" + "x\n" * 7 + "no newline at the end"
+
+def test_split_cuts_at_line_ends():
+    parts = chunks.split(CONTENT, size=10)
+    assert "".join(text for first, text in parts) == CONTENT
+    assert all(text.endswith('\n') for first, text in parts[:-1])
+    # Each chunk starts on the line after the previous one's last
+    line = 1
+    for first, text in parts:
+        assert first == line
+        line += text.count('\n')
+
+def test_split_blocks_matches_split():
+    for block in (1, 3, 7, 100):
+        blocks = [CONTENT[i:i + block] for i in range(0, len(CONTENT), block)]
+        assert list(chunks.split_blocks(blocks, size=10)) == chunks.split(CONTENT, size=10)
+    assert list(chunks.split_blocks([])) == []
+
+def test_decode_keeps_characters_cut_between_reads():
+    text = "é" * 10 + "\n" + "日本" * 5
+    assert "".join(chunks.decode(io.BytesIO(text.encode('utf-8')), size=3)) == text
+    with pytest.raises(UnicodeDecodeError):
+        list(chunks.decode(io.BytesIO(b"ok\n\xff\xfe")))
+
+def test_locate():
+    line_index = [1, 5, 9]
+    assert [chunks.locate(line_index, line) for line in (1, 4, 5, 8, 9, 100)] == [0, 0, 1, 1, 2, 2]
+
+def test_select_lines():
+    # A chunk starting at line 5
+    text = "e\nf\ng\nh"
+    assert chunks.select_lines(text, 5, 5, 5) == "e\n"
+    assert chunks.select_lines(text, 5, 6, 7) == "f\ng\n"
+    assert chunks.select_lines(text, 5, 7, 20) == "g\nh"
+    assert chunks.select_lines(text, 5, 20, 30) == ""
+
+def test_count_lines():
+    assert chunks.count_lines("") == 0
+    assert chunks.count_lines("a") == 1
+    assert chunks.count_lines("a\n") == 1
+    assert chunks.count_lines("a\n\nb") == 3
@@ -0,0 +1,29 @@
+import gzip
+import compression
+
+TEXT = "def f():\n    return 'héllo'\n" * 100
+
+def test_small_contents_are_stored_raw():
+    blob = compression.pack("héllo\n")
+    assert blob[:1] == compression.RAW
+    assert compression.unpack(blob) == "héllo\n"
+    assert compression.gzipped(blob) is None
+
+def test_big_contents_are_gzipped():
+    blob = compression.pack(TEXT)
+    assert blob[:1] == compression.GZIP
+    assert len(blob) < len(TEXT)
+    assert compression.unpack(blob) == TEXT
+    # Sent as is with Content-Encoding: gzip
+    assert gzip.decompress(compression.gzipped(blob)) == TEXT.encode('utf-8')
+
+def test_same_content_same_blob():
+    # No timestamp in the gzip header, and text or its utf-8 bytes give the same blob and hash
+    assert compression.pack(TEXT) == compression.pack(TEXT.encode('utf-8'))
+    assert compression.content_hash(TEXT) == compression.content_hash(TEXT.encode('utf-8'))
+    assert compression.content_hash(TEXT) != compression.content_hash(TEXT + "\n")
+
+def test_stored_memoryview_unpacks():
+    # psycopg2 returns bytea columns as memoryviews
+    assert compression.unpack(memoryview(compression.pack("héllo"))) == "héllo"
+    assert compression.unpack(memoryview(compression.pack(TEXT))) == TEXT
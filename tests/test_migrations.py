@@ -0,0 +1,101 @@
+import contextlib
+import db
+import migrations
+
+class FakeCursor:
+    def __init__(self, results=()):
+        self.sql = []
+        self.results = list(results)
+
+    def execute(self, sql, args=None):
+        self.sql.append(sql)
+
+    def fetchone(self):
+        return (self.results.pop(0), )
+
+class FakeConnection:
+    def __init__(self, cursor):
+        self.cur = cursor
+        self.closed = False
+
+    def cursor(self):
+        return self.cur
+
+    def close(self):
+        self.closed = True
+
+def bare_db():
+    """ A DB that never connects, its methods are replaced by the tests """
+    return db.DB.__new__(db.DB)
+
+def db_with_cursor(cur):
+    """ A DB whose every cursor() is cur """
+    database = bare_db()
+    @contextlib.contextmanager
+    def cursor(autocommit=False):
+        yield cur
+    database.cursor = cursor
+    return database
+
+def test_advisory_lock_is_polled():
+    cur = FakeCursor([False, False, True])
+    conn = FakeConnection(cur)
+    database = bare_db()
+    database.connect = lambda: conn
+    with database.advisory_lock(migrations.ADVISORY_LOCK, poll=0):
+        assert cur.sql == ["SELECT pg_try_advisory_lock(%s)"] * 3
+        assert not conn.closed
+    # Closing the connection releases the lock
+    assert conn.closed
+
+def test_create_index_checks_validity_before_taking_a_connection():
+    database = bare_db()
+    database.indexes = {'pastes': (("pastes_author", "(author)"), )}
+    cur = FakeCursor()
+    open_cursors = []
+    @contextlib.contextmanager
+    def cursor(autocommit=False):
+        open_cursors.append(cur)
+        yield cur
+        open_cursors.pop()
+    def index_valid(name):
+        assert not open_cursors
+        return False
+    database.cursor = cursor
+    database.index_valid = index_valid
+    migrations.CreateIndex('pastes', 'pastes_author').run(database)
+    assert cur.sql == ["DROP INDEX CONCURRENTLY IF EXISTS pastes_author",
+                       "CREATE INDEX CONCURRENTLY IF NOT EXISTS pastes_author ON pastes (author)"]
+
+def batches(rows, calls):
+    """ A backfill batch over the keys in rows, recording the (last key, size) it's called with """
+    def batch(cur, last_key, size):
+        calls.append((last_key, size))
+        handled = [key for key in rows if key > last_key][:size]
+        cur.execute("batch after %r" % last_key)
+        return len(handled), handled[-1] if handled else last_key
+    return batch
+
+def test_backfill_finish_handles_every_row_left_in_one_transaction():
+    calls = []
+    cur = FakeCursor()
+    backfill = migrations.Backfill("test", batches(["a", "b", "c", "d", "e"], calls), batch_size=2)
+    assert backfill.finish(cur) == 5
+    assert calls == [("", 2), ("b", 2), ("d", 2)]
+
+def test_drop_column_backfills_the_rows_left_with_the_table_locked():
+    calls = []
+    cur = FakeCursor()
+    database = db_with_cursor(cur)
+    backfill = migrations.Backfill("test", batches(["a", "b", "c"], calls), batch_size=2)
+    migrations.DropColumn('pastes', 'content', backfill=backfill).run(database)
+    assert cur.sql == ["SET LOCAL lock_timeout = %s",
+                       "LOCK TABLE pastes IN ACCESS EXCLUSIVE MODE",
+                       "batch after ''", "batch after 'b'",
+                       "ALTER TABLE pastes DROP COLUMN IF EXISTS content"]
+
+def test_drop_column_without_backfill():
+    cur = FakeCursor()
+    database = db_with_cursor(cur)
+    migrations.DropColumn('pastes', 'content').run(database)
+    assert cur.sql == ["SET LOCAL lock_timeout = %s", "ALTER TABLE pastes DROP COLUMN IF EXISTS content"]
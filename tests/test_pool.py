@@ -0,0 +1,88 @@
+import threading
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+import pytest
+import db
+
+class FakeConnection:
+    def __init__(self, ping_fails=False):
+        self.closed = False
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        self.rollbacks = 0
+        self.ping_fails = ping_fails
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql):
+        if self.ping_fails:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+
+    def fetchone(self):
+        return (1, )
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = True
+
+def pool(monkeypatch, **kwargs):
+    opened = []
+    def open(self):
+        opened.append(FakeConnection())
+        return opened[-1]
+    monkeypatch.setattr(db.ConnectionPool, '_ConnectionPool__open', open)
+    return db.ConnectionPool({}, **kwargs), opened
+
+def test_connections_are_reused(monkeypatch):
+    connections, opened = pool(monkeypatch, minconn=1, maxconn=2)
+    conn = connections.getconn()
+    connections.putconn(conn)
+    assert connections.getconn() is conn
+    assert len(opened) == 1
+    stats = connections.stats()
+    assert (stats['checkouts'], stats['open'], stats['in_use']) == (2, 1, 1)
+
+def test_open_transactions_are_rolled_back_on_return(monkeypatch):
+    connections, opened = pool(monkeypatch)
+    conn = connections.getconn()
+    conn.status = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+    connections.putconn(conn)
+    assert conn.rollbacks == 1
+    assert connections.getconn() is conn
+
+def test_broken_connections_are_replaced(monkeypatch):
+    connections, opened = pool(monkeypatch, maxconn=1)
+    conn = connections.getconn()
+    connections.putconn(conn, broken=True)
+    assert conn.closed
+    assert connections.stats()['open'] == 0
+    assert connections.getconn() is not conn
+    assert len(opened) == 2
+
+def test_stale_connections_are_reconnected(monkeypatch):
+    connections, opened = pool(monkeypatch, check_after=0)
+    opened[0].ping_fails = True
+    conn = connections.getconn()
+    assert conn is opened[1]
+    assert opened[0].closed
+    assert connections.stats()['reconnects'] == 1
+
+def test_waits_for_a_connection_up_to_the_timeout(monkeypatch):
+    connections, opened = pool(monkeypatch, maxconn=1, timeout=0.05)
+    conn = connections.getconn()
+    with pytest.raises(psycopg2.pool.PoolError):
+        connections.getconn()
+    assert connections.stats()['timeouts'] == 1
+    # A connection returned meanwhile goes to the waiting thread
+    connections.timeout = 5
+    threading.Timer(0.05, connections.putconn, (conn, )).start()
+    assert connections.getconn() is conn
+    assert len(opened) == 1
+    assert connections.stats()['waits'] == 1
@@ -0,0 +1,46 @@
+import ratelimit
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+def test_buckets_refill_at_their_rate(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit, 'time', clock)
+    buckets = ratelimit.MemoryBuckets()
+    assert [buckets.take('client', 2.0, 3) for i in range(3)] == [0, 0, 0]
+    assert buckets.take('client', 2.0, 3) == 0.5
+    clock.now += 0.5
+    assert buckets.take('client', 2.0, 3) == 0
+    # Refilled up to the burst only
+    clock.now += 60
+    assert [buckets.take('client', 2.0, 3) for i in range(4)] == [0, 0, 0, 0.5]
+
+def test_idle_and_extra_buckets_are_forgotten(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit, 'time', clock)
+    buckets = ratelimit.MemoryBuckets(idle=10, max_buckets=2)
+    buckets.take('a', 1.0, 1)
+    clock.now += 5
+    buckets.take('b', 1.0, 1)
+    buckets.take('c', 1.0, 1)
+    assert list(buckets.buckets) == ['b', 'c']
+    clock.now += 11
+    buckets.take('c', 1.0, 1)
+    assert list(buckets.buckets) == ['c']
+    assert len(buckets) == 1
+
+def test_check_uses_the_route_limit(monkeypatch):
+    monkeypatch.setattr(ratelimit, 'time', Clock())
+    monkeypatch.setattr(ratelimit, 'store', ratelimit.MemoryBuckets())
+    monkeypatch.setattr(ratelimit, 'RATE_LIMITS', {'index': (1.0, 1), '*': (1.0, 2)})
+    assert ratelimit.check('1.2.3.4', 'index') == 0
+    assert ratelimit.check('1.2.3.4', 'index') == 1.0
+    # Every client and route has its own bucket, routes not listed get '*'
+    assert ratelimit.check('5.6.7.8', 'index') == 0
+    assert [ratelimit.check('1.2.3.4', 'raw') for i in range(3)] == [0, 0, 1.0]
+    monkeypatch.setattr(ratelimit, 'RATE_LIMITS', {'index': (1.0, 1)})
+    assert ratelimit.check('1.2.3.4', 'raw') == 0
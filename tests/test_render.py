@@ -0,0 +1,59 @@
+import html
+import render
+
+PAGE = 1000
+
+def rendering(lines, first, last, language='text'):
+    return render.render("".join(lines[first - 1:last]), language)
+
+def inner(rendering):
+    """ The highlighted lines of a rendering, without the markup around them """
+    return rendering.split('<pre>', 1)[1].rsplit('</pre>', 1)[0].replace('<span></span>', '')
+
+def plain(rendering):
+    """ The text of the lines of a rendering made with the text lexer """
+    return html.unescape(inner(rendering))
+
+def test_pages_keep_blank_lines_at_both_ends():
+    lines = ["line %d\n" % i for i in range(1, 2501)]
+    # Page 1 ends and page 2 starts and ends with blank lines
+    for blank in (999, 1000, 1001, 1002, 2000):
+        lines[blank - 1] = "\n"
+    page = rendering(lines, 1001, 2000)
+    assert plain(page) == "".join(lines[1000:2000])
+    assert plain(page).count("\n") == PAGE
+
+def test_cut_across_pages_lines_up_with_the_line_numbers():
+    lines = ["line %d\n" % i for i in range(1, 2501)]
+    for blank in (1000, 1001):
+        lines[blank - 1] = "\n"
+    pages = [rendering(lines, 1, 1000), rendering(lines, 1001, 2000)]
+    for first, last in [(998, 1003), (1000, 1001), (1001, 1001), (1, 2000), (995, 1000)]:
+        cut = render.cut(pages, 1, first, last)
+        assert plain(cut) == "".join(lines[first - 1:last])
+        assert cut.startswith('<div class="highlight"><pre>')
+        assert cut.endswith('</pre></div>\n')
+
+def test_cut_matches_rendering_the_window_directly():
+    lines = ["x = %d  # <%d>\n" % (i, i) for i in range(1, 2101)]
+    lines[1000] = "\n"
+    pages = [rendering(lines, 1, 1000, 'python'), rendering(lines, 1001, 2000, 'python')]
+    assert inner(render.cut(pages, 1, 990, 1010)) == inner(rendering(lines, 990, 1010, 'python'))
+
+def test_last_line_without_newline():
+    lines = ["a\n", "\n", "b"]
+    page = rendering(lines, 1, 3)
+    assert plain(page) == "a\n\nb\n"
+    assert plain(render.cut([page], 1, 2, 3)) == "\nb\n"
+
+def test_windows_of_a_paste_line_up(pastes):
+    lines = ["line %d\n" % i for i in range(1, 2501)]
+    for blank in (1000, 1001, 2000):
+        lines[blank - 1] = "\n"
+    paste = pastes.get(pastes.create("".join(lines), False, "me", "text"))
+    assert paste.window(page=2) == (1001, 2000)
+    assert paste.renderWindows((998, 1003)) == [(1, 1000), (1001, 2000)]
+    for window in [(1001, 2000), (998, 1003), (2000, 2001)]:
+        paste.formattedContent(window) # renders the missing pages
+        assert paste.isRendered(window)
+        assert plain(paste.formattedContent(window)) == "".join(lines[window[0] - 1:window[1]])
@@ -0,0 +1,46 @@
+import pytest
+import repo
+
+def test_unknown_language_is_refused_before_storing(pastes):
+    with pytest.raises(ValueError):
+        pastes.create("hello\n", False, "me", "no-such-language")
+    assert not repo.db.tables['pastes']
+    assert not repo.db.tables['blobs']
+
+def test_known_and_guessed_languages(pastes):
+    assert pastes.get(pastes.create("hello\n", False, "me", "py3")).language == "py3"
+    assert pastes.get(pastes.create("#!/bin/sh\necho hi\n", False, "me", "guess")).language == "sh"
+
+BIG = "".join("line %d\n" % i for i in range(60000))
+
+def test_chunks_are_written_before_the_blob_row(pastes, monkeypatch):
+    add_reference = repo.db.add_reference
+    def checked(table_name, data, key_column, count_column, insert=True):
+        if insert and data['hash'] not in repo.db.tables['blobs']:
+            assert repo.db.count_data('chunks', 'hash', data['hash']) == len(data['line_index'])
+        return add_reference(table_name, data, key_column, count_column, insert)
+    monkeypatch.setattr(repo.db, 'add_reference', checked)
+    id = pastes.create(BIG, False, "me", "text")
+    assert pastes.get(id).isChunked()
+
+def test_failed_chunk_write_leaves_no_blob(pastes, monkeypatch):
+    monkeypatch.setattr(repo.db, 'add_many', lambda *args, **kwargs: False)
+    with pytest.raises(ValueError):
+        pastes.create(BIG, False, "me", "text")
+    assert not repo.db.tables['blobs']
+    assert not repo.db.tables['pastes']
+
+def test_chunks_deleted_by_a_concurrent_delete_are_written_again(pastes, monkeypatch):
+    # Another create of the same content stores its blobs row and its paste is deleted while ours
+    #   writes the chunks: the delete takes them all along
+    add_many = repo.db.add_many
+    def racing(table_name, rows, page_size=500, ignore_duplicates=False):
+        done = add_many(table_name, rows, page_size, ignore_duplicates)
+        if not repo.db.tables['blobs']:
+            for key in [key for key in repo.db.tables['chunks'] if key[0] == rows[0]['hash']]:
+                del repo.db.tables['chunks'][key]
+        return done
+    monkeypatch.setattr(repo.db, 'add_many', racing)
+    id = pastes.create(BIG, False, "me", "text")
+    pastes.pastes.clear()
+    assert pastes.get(id).content == BIG